@@ -0,0 +1,241 @@
+import bpy
+import bmesh
+import numpy as np
+import argparse
+import random
+import json
+import time
+import os
+import sys
+
+# Headless benchmark of the geometry builders in the scripts folder with
+# parameter sweeps, run it with
+#
+#   blender -b --python benchmark.py -- --output benchmark.json
+#   blender -b --python benchmark.py -- --compare benchmark.json
+#
+# Each builder is set up first and only the builder itself is timed.
+
+filesDir = os.path.dirname(os.path.abspath(__file__))
+cwd = os.path.join(filesDir, "scripts")
+sys.path.append(cwd)
+os.chdir(cwd)
+
+from tetrahedron_fractal import tetrahedron_points, recursive_tetrahedron, \
+    tetrahedron_fractal
+from parametric_torus import torus_surface, create_surface
+from voronoi_sphere import VoronoiSphere
+from voronoi_landscape import voronoi_landscape
+from phyllotaxis_flower import PhyllotaxisFlower
+from fisher_iris_visualization import create_scatter
+from metaballs import createMetaball, createMetaballMesh
+from utils.telemetry import memory_mb, reset_peak_memory
+
+
+def mesh_counts(objects):
+    verts = sum(len(obj.data.vertices) for obj in objects)
+    faces = sum(len(obj.data.polygons) for obj in objects)
+    return verts, faces
+
+
+# Each benchmark sets up its input and returns the function to be timed,
+# which returns the number of vertices and faces of the geometry
+
+def bench_recursive_tetrahedron(level):
+    def run():
+        bm = bmesh.new()
+        recursive_tetrahedron(bm, tetrahedron_points(5), level)
+        counts = len(bm.verts), len(bm.faces)
+        bm.free()
+        return counts
+    return run
+
+
+def bench_tetrahedron_fractal(level):
+    def run():
+        verts, faces = tetrahedron_fractal(tetrahedron_points(5), level)
+        return len(verts), len(faces)
+    return run
+
+
+def bench_create_surface(n, m):
+    return lambda: mesh_counts([create_surface(torus_surface(4, 2), n, m)])
+
+
+def bench_voronoi_sphere(n, bounded=False):
+    points = (np.random.random((n, 3)) - 0.5)*2*2
+    def run():
+        verts, loops, face_sizes, material_indices = VoronoiSphere(
+            points, 2, bounded=bounded)
+        return len(verts), len(face_sizes)
+    return run
+
+
+def bench_voronoi_landscape(n):
+    return lambda: mesh_counts([voronoi_landscape(n)])
+
+
+def bench_phyllotaxis_geometry(n, m, frame):
+    flower = PhyllotaxisFlower(bpy.context.scene, n=n, m=m)
+    faces = len(flower.obj.data.polygons)
+    return lambda: (len(flower.geometry(frame)), faces)
+
+
+def bench_create_scatter(rows, instance=False):
+    X = np.random.normal(size=(rows, 3))
+    y = np.random.randint(3, size=rows)
+    return lambda: mesh_counts(create_scatter(X, y, instance=instance))
+
+
+def bench_create_metaball(elements):
+    def run():
+        # The metaball is only polygonized when it is evaluated
+        obj = createMetaball(n=elements)
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        obj_eval = obj.evaluated_get(depsgraph)
+        mesh = obj_eval.to_mesh()
+        counts = len(mesh.vertices), len(mesh.polygons)
+        obj_eval.to_mesh_clear()
+        return counts
+    return run
+
+
+def bench_create_metaball_mesh(elements):
+    return lambda: mesh_counts([createMetaballMesh(n=elements, cache=False)])
+
+
+# Builders with the parameter sweep over the size of the geometry
+BENCHMARKS = {
+    'recursive_tetrahedron': (bench_recursive_tetrahedron,
+        [dict(level=level) for level in range(6)]),
+    'tetrahedron_fractal': (bench_tetrahedron_fractal,
+        [dict(level=level) for level in range(8)]),
+    'create_surface': (bench_create_surface,
+        [dict(n=n, m=n) for n in (32, 128, 512, 1024)]),
+    'VoronoiSphere': (bench_voronoi_sphere,
+        [dict(n=n) for n in (500, 2000, 8000, 32000)]),
+    'voronoi_landscape': (bench_voronoi_landscape,
+        [dict(n=n) for n in (250, 1000, 4000, 16000)]),
+    'PhyllotaxisFlower.geometry': (bench_phyllotaxis_geometry,
+        [dict(n=n, m=m, frame=frame) for n, m in ((40, 30), (80, 60), (160, 120))
+         for frame in (0, 10)]),
+    'create_scatter': (bench_create_scatter,
+        [dict(rows=rows) for rows in (150, 1000, 10000, 100000)]),
+    'createMetaball': (bench_create_metaball,
+        [dict(elements=elements) for elements in (10, 30, 100)]),
+    'createMetaballMesh': (bench_create_metaball_mesh,
+        [dict(elements=elements) for elements in (10, 30, 100)])
+}
+
+
+def run_benchmark(name, params, repeat=3):
+    # Minimum wall time over the repetitions, the peak memory above the
+    # memory before the builder of the first repetition and the counts
+    bench, _ = BENCHMARKS[name]
+    seconds, peak_memory, counts = [], None, None
+    for i in range(repeat):
+        # Start each repetition with an empty scene and the same seed
+        bpy.ops.wm.read_homefile(use_empty=True)
+        np.random.seed(0)
+        random.seed(0)
+        run = bench(**params)
+
+        memory = memory_mb('VmRSS')
+        reset_peak_memory()
+        start = time.perf_counter()
+        counts = run()
+        seconds.append(time.perf_counter() - start)
+        if i == 0 and memory is not None:
+            peak_memory = memory_mb('VmHWM') - memory
+
+    return {
+        'builder': name,
+        'params': params,
+        'seconds': min(seconds),
+        'peak_memory_mb': peak_memory,
+        'verts': counts[0],
+        'faces': counts[1]
+    }
+
+
+def case_key(result):
+    return result['builder'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(results, baseline, threshold=1.2, min_seconds=0.01, min_mb=1.0):
+    # Flag results which are slower or use more memory than the baseline
+    # by more than the threshold factor, or which changed the geometry
+    baseline = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    print('{:<28} {:<32} {:>10} {:>10} {:>8}  {}'.format(
+        'builder', 'params', 'base [s]', 'time [s]', 'ratio', 'status'))
+    for result in results:
+        base = baseline.get(case_key(result))
+        if base is None:
+            continue
+        status = []
+        if result['seconds'] > threshold*base['seconds'] and \
+                result['seconds'] - base['seconds'] > min_seconds:
+            status.append('SLOWER')
+        if result['peak_memory_mb'] is not None and \
+                base['peak_memory_mb'] is not None and \
+                result['peak_memory_mb'] > threshold*base['peak_memory_mb'] and \
+                result['peak_memory_mb'] - base['peak_memory_mb'] > min_mb:
+            status.append('MEMORY')
+        if (result['verts'], result['faces']) != (base['verts'], base['faces']):
+            status.append('GEOMETRY')
+        if status:
+            regressions.append((result, status))
+        print('{:<28} {:<32} {:>10.4f} {:>10.4f} {:>8.2f}  {}'.format(
+            result['builder'], case_key(result)[1], base['seconds'],
+            result['seconds'], result['seconds'] / max(base['seconds'], 1e-9),
+            ' '.join(status) or 'ok'))
+    return regressions
+
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--output', default=None,
+        help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None,
+        help='compare the results to this baseline JSON file')
+    parser.add_argument('--only', nargs='+', default=list(BENCHMARKS),
+        choices=list(BENCHMARKS), help='builders to benchmark')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+        help='only run the two smallest sizes of each sweep')
+    parser.add_argument('--threshold', type=float, default=1.2,
+        help='factor above the baseline which is a regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.only:
+        _, sweep = BENCHMARKS[name]
+        for params in sweep[:2] if args.quick else sweep:
+            result = run_benchmark(name, params, args.repeat)
+            print('{:<28} {:<32} {:>10.4f} s {:>8} MB {:>9} verts {:>9} faces'
+                  .format(name, case_key(result)[1], result['seconds'],
+                  '{:.1f}'.format(result['peak_memory_mb'])
+                  if result['peak_memory_mb'] is not None else '-',
+                  result['verts'], result['faces']))
+            results.append(result)
+
+    report = {
+        'blender': bpy.app.version_string,
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'results': results
+    }
+    if args.output is not None:
+        with open(os.path.join(filesDir, args.output), 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(os.path.join(filesDir, args.compare)) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{} regressions against {}'.format(
+                len(regressions), args.compare))
+            sys.exit(1)
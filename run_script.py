@@ -1,8 +1,14 @@
 import bpy
+import traceback
+import functools
+import time
+import glob
 import os
 import sys
 
-# Specify the script to be executed
+# Specify the script to be executed, which can also be a list of scripts
+# or a glob pattern like "*.py" to run all scripts in one Blender session.
+# Scripts can also be given after "--" with blender -b -P run_script.py -- *.py
 scriptFile = "fisher_iris_visualization.py"
 
 # Check if script is executed in Blender and get absolute path of current folder
@@ -11,12 +17,141 @@ if bpy.context.space_data is not None:
 else:
     filesDir = os.path.dirname(os.path.abspath(__file__))
 
+# Remember the absolute path of this file for Blender worker processes,
+# which run the script again after the working directory has changed
+os.environ['BLENDER_RUN_SCRIPT'] = os.path.join(filesDir, 'run_script.py')
+
 # Get scripts folder and add it to the search path for modules
 cwd = os.path.join(filesDir, "scripts")
 sys.path.append(cwd)
 # Change current working directory to scripts folder
 os.chdir(cwd)
 
-# Compile and execute script file
-file = os.path.join(cwd, scriptFile)
-exec(compile(open(file).read(), scriptFile, 'exec'))
+import utils
+
+
+def is_scene_script(file):
+    # Scripts which build a Blender scene import bpy, other modules in the
+    # scripts folder are only helpers of these scripts
+    with open(file) as f:
+        return any(line.startswith('import bpy') for line in f)
+
+
+def resolve_scripts(scriptFiles):
+    # Absolute paths of the scripts from file names and glob patterns,
+    # where patterns only match scene scripts
+    if isinstance(scriptFiles, str):
+        scriptFiles = [scriptFiles]
+    files = []
+    for pattern in scriptFiles:
+        matches = sorted(glob.glob(os.path.join(cwd, pattern)))
+        if not glob.has_magic(pattern):
+            files.append(os.path.join(cwd, pattern))
+        else:
+            files.extend(file for file in matches if is_scene_script(file))
+    return files
+
+
+# Functions of utils which are timed as scene setup or as render, the
+# rest of the time of a script is spent on its geometry. The render time
+# includes waiting for the render worker processes.
+STAGE_FUNCTIONS = {
+    'remove_all': 'setup', 'reset_scene': 'setup', 'simple_scene': 'setup',
+    'create_target': 'setup', 'create_camera': 'setup',
+    'create_light': 'setup', 'rainbow_lights': 'setup',
+    'create_material': 'setup', 'render': 'render'
+}
+stage_timer = {'stage': None, 'setup': 0.0, 'render': 0.0}
+
+
+def timed(func, stage):
+    # Add the time of the call to the stage, nested calls are only
+    # counted by the outermost timed function
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if stage_timer['stage'] is not None:
+            return func(*args, **kwargs)
+        stage_timer['stage'] = stage
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_timer[stage] += time.perf_counter() - start
+            stage_timer['stage'] = None
+    return wrapper
+
+
+def run_batch(files):
+    # Run all scripts in this Blender session, a failing script is
+    # reported and does not abort the remaining scripts
+    functions = {name: getattr(utils, name) for name in STAGE_FUNCTIONS}
+    for name, stage in STAGE_FUNCTIONS.items():
+        setattr(utils, name, timed(functions[name], stage))
+    script_file = os.environ.get('BLENDER_SCRIPT_FILE')
+
+    results = []
+    try:
+        for i, file in enumerate(files):
+            name = os.path.basename(file)
+            print('Running {} ({}/{})'.format(name, i + 1, len(files)))
+            status = 'ok'
+            stage_timer['setup'], stage_timer['render'] = 0.0, 0.0
+            start = time.perf_counter()
+            try:
+                if i > 0:
+                    if bpy.context.space_data is None:
+                        # Reset all scenes and data-blocks to the startup
+                        # file, which is the same state as in a newly
+                        # started Blender
+                        bpy.ops.wm.read_homefile()
+                    else:
+                        # Keep the open file in the user interface, but do
+                        # not time the script on the objects of the last one
+                        functions['reset_scene']()
+                os.chdir(cwd)
+                # Worker processes started by the script only run this script
+                os.environ['BLENDER_SCRIPT_FILE'] = file
+                # Each script starts from the seed its worker processes use
+                utils.rendering.seed_random()
+                code = compile(open(file).read(), name, 'exec')
+                stage_timer['setup'] += time.perf_counter() - start
+
+                exec(code, {'__name__': '__main__', '__file__': file})
+            except Exception:
+                traceback.print_exc()
+                status = 'failed'
+            total = time.perf_counter() - start
+            setup, render = stage_timer['setup'], stage_timer['render']
+            results.append((name, status, setup, total - setup - render,
+                            render))
+    finally:
+        for name, func in functions.items():
+            setattr(utils, name, func)
+        if script_file is None:
+            os.environ.pop('BLENDER_SCRIPT_FILE', None)
+        else:
+            os.environ['BLENDER_SCRIPT_FILE'] = script_file
+
+    # Report the time spent in each stage per script
+    print('{:<32} {:<8} {:>10} {:>12} {:>10}'.format(
+        'script', 'status', 'setup [s]', 'geometry [s]', 'render [s]'))
+    for name, status, setup, geometry, render in results:
+        print('{:<32} {:<8} {:>10.2f} {:>12.2f} {:>10.2f}'.format(
+            name, status, setup, geometry, render))
+
+    return results
+
+
+if 'BLENDER_SCRIPT_FILE' in os.environ:
+    files = [os.environ['BLENDER_SCRIPT_FILE']]
+elif '--' in sys.argv:
+    files = resolve_scripts(sys.argv[sys.argv.index('--') + 1:])
+else:
+    files = resolve_scripts(scriptFile)
+
+if len(files) == 1:
+    # Compile and execute script file
+    file = files[0]
+    exec(compile(open(file).read(), os.path.basename(file), 'exec'))
+else:
+    run_batch(files)
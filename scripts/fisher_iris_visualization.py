@@ -2,111 +2,400 @@ import bpy
 import bmesh
 import numpy as np
 import utils
-from mathutils import Vector, Matrix
+from mathutils import Vector
 from math import pi
+import itertools as it
+import json
 import os
 
+class IncrementalPCA():
+    # Principal Component Analysis which updates the mean and covariance
+    # one chunk at a time and solves the eigenproblem once at the end.
+    # The randomized solver never forms the covariance matrix, instead it
+    # makes a few more passes over the chunks with d x l matrices only.
+    def __init__(self, num_components=None, solver='full',
+                 num_oversamples=10, num_iterations=4, seed=None):
+        self.num_components = num_components
+        self.solver = solver  # 'full' or 'randomized'
+        self.num_oversamples = num_oversamples
+        self.num_iterations = num_iterations
+        self.seed = seed
+        self.count = 0
+        self.mean, self.scatter = None, None
+        self.eigenvalues, self.components = None, None
+
+
+    def partial_fit(self, data):
+        data = np.asarray(data, dtype=float)
+        count, mean = len(data), data.mean(axis=0)
+        scatter = None
+        if self.solver != 'randomized':
+            centered = data - mean
+            scatter = centered.T @ centered
+
+        # Merge the chunk statistics with the running mean and scatter
+        # matrix (Chan et al. parallel algorithm)
+        if self.count == 0:
+            self.mean, self.scatter = mean, scatter
+        else:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta*count/total
+            if scatter is not None:
+                self.scatter += scatter + \
+                    np.outer(delta, delta)*self.count*count/total
+        self.count += count
+        return self
+
+
+    def fit(self, chunks):
+        # The chunks are an iterable, or a function which returns a new
+        # iterable of the chunks for each pass over the data, which the
+        # randomized solver needs
+        if self.solver == 'randomized':
+            if not callable(chunks):
+                raise ValueError('The randomized solver needs a function '
+                                 'which returns the chunks for each pass')
+            for chunk in chunks():
+                self.partial_fit(chunk)
+            return self.solve_randomized(chunks)
+        for chunk in chunks() if callable(chunks) else chunks:
+            self.partial_fit(chunk)
+        return self.solve()
+
+
+    def solve(self):
+        # Covariance matrix with the same normalization as np.cov
+        R = self.scatter / max(self.count - 1, 1)
+
+        # use 'eigh' rather than 'eig' since R is symmetric,
+        # the performance gain is substantial
+        V, E = np.linalg.eigh(R)
+        return self.set_components(V, E)
+
+
+    def solve_randomized(self, chunks):
+        # Randomized subspace iteration for a few leading components, where
+        # the products with the covariance matrix are summed over the chunks
+        d = len(self.mean)
+        k = self.num_components or d
+        size = min(k + self.num_oversamples, d)
+        norm = max(self.count - 1, 1)
+
+        def project(Q):
+            # Covariance matrix times Q and the projection Q^T R Q
+            RQ = np.zeros((d, Q.shape[1]))
+            QRQ = np.zeros((Q.shape[1], Q.shape[1]))
+            for chunk in chunks():
+                centered = np.asarray(chunk, dtype=float) - self.mean
+                Z = centered @ Q
+                RQ += centered.T @ Z
+                QRQ += Z.T @ Z
+            return RQ / norm, QRQ / norm
+
+        if size == d:
+            # The subspace is the whole space, which needs no iterations
+            Q = np.eye(d)
+        else:
+            rng = np.random.default_rng(self.seed)
+            Q = rng.standard_normal((d, size))
+            for i in range(self.num_iterations + 1):
+                Q = np.linalg.qr(project(Q)[0])[0]
+        V, E = np.linalg.eigh(project(Q)[1])
+        return self.set_components(V, Q @ E)
+
+
+    def set_components(self, V, E):
+        # sort eigenvalues and eigenvectors in decreasing order
+        k = self.num_components or len(V)
+        idx = np.argsort(V)[::-1]
+        self.eigenvalues = V[idx]
+        self.components = E[:, idx][:, :k]
+        return self
+
+
+    def transform(self, data):
+        # Project the data without modifying the given array
+        return (np.asarray(data, dtype=float) - self.mean) @ self.components
+
+
+    def transform_chunks(self, chunks):
+        for chunk in chunks:
+            yield self.transform(chunk)
+
+
+def iter_chunks(data, chunk_size=100000):
+    # Iterate over rows of an array or memory-mapped array in chunks
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
 def PCA(data, num_components=None):
-    # mean center the data
-    data -= data.mean(axis=0)
-    # calculate the covariance matrix
-    R = np.cov(data, rowvar=False)
-    # calculate eigenvectors & eigenvalues of the covariance matrix
-    # use 'eigh' rather than 'eig' since R is symmetric,
-    # the performance gain is substantial
-    V, E = np.linalg.eigh(R)
-    # sort eigenvalue in decreasing order
-    idx = np.argsort(V)[::-1]
-    E = E[:,idx]
-    # sort eigenvectors according to same index
-    V = V[idx]
-    # select the first n eigenvectors (n is desired dimension
-    # of rescaled data array, or dims_rescaled_data)
-    E = E[:, :num_components]
-    # carry out the transformation on the data using eigenvectors
+    # Carry out the transformation on the data using eigenvectors
     # and return the re-scaled data, eigenvalues, and eigenvectors
-    return np.dot(E.T, data.T).T, V, E
+    pca = IncrementalPCA(num_components).fit(iter_chunks(data))
+    return pca.transform(data), pca.eigenvalues, pca.components
+
+
+@utils.profile
+def load_csv(path, label_column=-1, delimiter=',', chunk_size=100000,
+             dtype=np.float32, cache=False):
+    # Load a CSV table of points with one class label column into the
+    # data matrix X, the target vector y and the list of labels
+    cache_paths = [os.path.splitext(path)[0] + suffix
+                   for suffix in ('.X.npy', '.y.npy', '.labels.npy')]
+    meta_path = os.path.splitext(path)[0] + '.meta.json'
+    # The cache is valid for the same parsing parameters and the same
+    # modification time and size of the CSV file it was written from
+    stat = os.stat(path)
+    meta = {'label_column': label_column, 'delimiter': delimiter,
+            'dtype': np.dtype(dtype).str, 'source_mtime': stat.st_mtime,
+            'source_size': stat.st_size}
+
+    def load_cache():
+        X = np.load(cache_paths[0], mmap_mode='r')
+        y = np.load(cache_paths[1], mmap_mode='r')
+        labels = np.load(cache_paths[2]).tolist()
+        return X, y, labels
+
+    # Memory-map the binary cache if it was written for the same file
+    if cache and all(os.path.exists(cache_path)
+                     for cache_path in cache_paths + [meta_path]):
+        with open(meta_path) as f:
+            cached_meta = json.load(f)
+        if cached_meta == meta:
+            return load_cache()
+
+    label_codes, labels = {}, []
+
+    def parse_chunks(f):
+        while True:
+            lines = list(it.islice(f, chunk_size))
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()]
+            if not lines:
+                continue
+
+            # Parse the chunk and split it into numeric values and labels
+            table = np.loadtxt(lines, delimiter=delimiter, dtype=str, ndmin=2)
+            X_chunk = np.delete(table, label_column, axis=1).astype(dtype)
+
+            # Map the labels to indices in order of their first appearance
+            names, first, inverse = np.unique(table[:, label_column],
+                return_index=True, return_inverse=True)
+            for name in names[np.argsort(first)]:
+                if name not in label_codes:
+                    label_codes[name] = len(labels)
+                    labels.append(str(name))
+            codes = np.array([label_codes[name] for name in names],
+                dtype=np.int32)
+            yield X_chunk, codes[inverse.reshape(-1)]
+
+    # An empty table has no rows and no known number of columns
+    empty = np.empty((0, 0), dtype=dtype), np.empty(0, dtype=np.int32), []
+
+    if not cache:
+        with open(path) as f:
+            chunks = list(parse_chunks(f))
+        if not chunks:
+            return empty
+        X_chunks, y_chunks = zip(*chunks)
+        return np.concatenate(X_chunks), np.concatenate(y_chunks), labels
+
+    # Stream the chunks to raw files, which are removed in any case
+    raw_paths = [cache_path + '.tmp' for cache_path in cache_paths[:2]]
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    try:
+        num_rows, num_columns = 0, None
+        with open(path) as f, open(raw_paths[0], 'wb') as raw_X, \
+                open(raw_paths[1], 'wb') as raw_y:
+            for X_chunk, y_chunk in parse_chunks(f):
+                X_chunk.tofile(raw_X)
+                y_chunk.tofile(raw_y)
+                num_rows += len(X_chunk)
+                num_columns = X_chunk.shape[1]
+        if num_rows == 0:
+            return empty
+
+        # Convert the raw chunks to .npy files which can be memory-mapped
+        for raw_path, cache_path, shape, raw_dtype in zip(raw_paths,
+                cache_paths, [(num_rows, num_columns), (num_rows,)],
+                [dtype, np.int32]):
+            raw = np.memmap(raw_path, dtype=raw_dtype, mode='r', shape=shape)
+            array = np.lib.format.open_memmap(cache_path, mode='w+',
+                dtype=raw_dtype, shape=shape)
+            array[:] = raw
+            array.flush()
+            del raw, array
+        np.save(cache_paths[2], np.array(labels))
+        # The parameters are written last, they mark the cache as complete
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    finally:
+        for raw_path in raw_paths:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+    return load_cache()
 
 
 def load_iris():
-    try:
-        # Load Iris dataset from the sklearn.datasets package
-        from sklearn import datasets
-        from sklearn import decomposition
-
-        # Load Dataset
-        iris = datasets.load_iris()
-        X = iris.data
-        y = iris.target
-        labels = iris.target_names
-
-        # Reduce components by Principal Component Analysis from sklearn
-        X = decomposition.PCA(n_components=3).fit_transform(X)
-    except ImportError:
-        # Load Iris dataset manually
-        path = os.path.join('data', 'iris', 'iris.data')
-        iris_data = np.genfromtxt(path, dtype='str', delimiter=',')
-        X = iris_data[:, :4].astype(dtype=float)
-        y = np.ndarray((X.shape[0],), dtype=int)
-
-        # Create target vector y and corresponding labels
-        labels, idx = [], 0
-        for i, label in enumerate(iris_data[:, 4]):
-            label = label.split('-')[1]
-            if label not in labels:
-                labels.append(label); idx += 1
-            y[i] = idx - 1
-
-        # Reduce components by implemented Principal Component Analysis
-        X = PCA(X, 3)[0]
+    # Load Iris dataset from the included UCI data set
+    path = os.path.join('data', 'iris', 'iris.data')
+    X, y, labels = load_csv(path)
+    labels = [label.split('-')[1] for label in labels]
+
+    # Reduce components by implemented Principal Component Analysis
+    X = PCA(X, 3)[0]
 
     return X, y, labels
 
 
-def create_scatter(X, y, size=0.25):
-    labelIndices = set(y)
+def group_by(keys):
+    # Group equal keys (or rows of keys) and return the unique keys,
+    # the group index of each key and the size of each group
+    keys = np.asarray(keys)
+    if keys.ndim == 2 and keys.dtype.kind in 'iu' and len(keys) > 0:
+        # Encode rows of integers as single integers, which sort much
+        # faster than rows, as long as the encoded values fit in int64
+        offsets = keys - keys.min(axis=0)
+        ranges = offsets.max(axis=0).astype(float) + 1
+        if np.prod(ranges) < 2**62:
+            strides = np.cumprod(np.r_[ranges[1:], 1][::-1])[::-1]
+            codes = offsets @ strides.astype(np.int64)
+            _, index, inverse, counts = np.unique(codes,
+                return_index=True, return_inverse=True, return_counts=True)
+            return keys[index], inverse.reshape(-1), counts
+
+    unique, inverse, counts = np.unique(keys, axis=0,
+        return_inverse=True, return_counts=True)
+    return unique, inverse.reshape(-1), counts
+
+
+def group_means(X, keys):
+    # Mean of the rows of X for each group of keys
+    unique, inverse, counts = group_by(keys)
+    X = np.asarray(X, dtype=float)
+    sums = np.stack([np.bincount(inverse, weights=X[:, d], minlength=len(unique))
+                     for d in range(X.shape[1])], axis=-1)
+    return unique, sums / counts[:, None]
+
+
+def pixel_size(distance, lens=35, resolution=512, sensor_width=36):
+    # Size of a pixel at the given distance from a perspective camera
+    return distance*sensor_width / (lens*resolution)
+
+
+@utils.profile
+def decimate_points(X, y, voxel_size, max_per_cell=1):
+    # Level of detail: keep at most max_per_cell points of each label in
+    # each voxel and return how many points each kept point stands for
+    X, y = np.asarray(X), np.asarray(y)
+    cells = np.floor(X / voxel_size).astype(np.int64)
+    _, inverse, counts = group_by(np.column_stack((cells, y)))
+
+    # Rank of each point inside its group in order of appearance
+    order = np.argsort(inverse, kind='stable')
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - starts[inverse[order]]
+    keep = rank < max_per_cell
+
+    counts = counts[inverse[keep]]
+    weights = counts / np.minimum(counts, max_per_cell)
+    return X[keep], y[keep], weights
+
+
+def weight_scales(weights, max_scale=2.0):
+    # Glyph scale for the number of points a kept point stands for, the
+    # cube root keeps the glyph volume proportional to the weight and the
+    # scale is clamped, so that dense voxels do not cover the whole plot
+    return np.clip(np.cbrt(np.asarray(weights, dtype=np.float32)),
+        1.0, max_scale)
+
+
+def glyph_template(label_idx, size=0.25):
+    # Create the shape primitive for a label once at the origin
+    bm = bmesh.new()
+    if label_idx % 3 == 0:
+        bmesh.ops.create_cube(bm, size=size)
+    elif label_idx % 3 == 1:
+        bmesh.ops.create_icosphere(bm, diameter=size/2)
+    else:
+        bmesh.ops.create_cone(bm,
+            segments=6, cap_ends=True,
+            diameter1=size/2, diameter2=0,
+            depth=size)
+    verts, loops, face_sizes = utils.bmesh_to_arrays(bm)
+    bm.free()
+
+    return verts, loops, face_sizes
+
+
+@utils.profile
+def create_scatter(X, y, size=0.25, instance=False, chunk_size=100000,
+                   scales=None):
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y)
+    if scales is not None and instance:
+        # Vertex instances all have the size of the glyph
+        raise ValueError('Glyph scales are not supported with instance=True')
+    if scales is None:
+        scales = np.ones(len(X), dtype=np.float32)
+    scales = np.asarray(scales, dtype=np.float32)
     colors = [(1, 0, 0, 1), (0, 1, 0, 1), (0, 0, 1, 1), \
               (1, 1, 0, 1), (1, 0, 1, 1), (0, 1, 1, 1)]
 
-    # Create a bmesh for each label
-    bmList = []
-    for labelIdx in labelIndices:
-        bmList.append(bmesh.new())
-
-    # Iterate through all the vectors and targets
-    for x, labelIdx in zip(X, y):
-        # Use the vector as translation for each point
-        T = Matrix.Translation(x)
-
-        if labelIdx % 3 == 0:
-            bmesh.ops.create_cube(bmList[labelIdx],
-                size=size, matrix=T)
-        elif labelIdx % 3 == 1:
-            bmesh.ops.create_icosphere(bmList[labelIdx],
-                diameter=size/2, matrix=T)
-        else:
-            bmesh.ops.create_cone(bmList[labelIdx],
-                segments=6, cap_ends=True,
-                diameter1=size/2, diameter2=0,
-                depth=size, matrix=T)
-
     objects = []
-    for labelIdx, color in zip(labelIndices, colors):
-        # Create a mesh from the existing bmesh
-        mesh = bpy.data.meshes.new('ScatterMesh {}'.format(labelIdx))
-        bmList[labelIdx].to_mesh(mesh)
-        bmList[labelIdx].free()
+    for labelIdx in np.unique(y):
+        points = X[y == labelIdx]
+        points_scales = scales[y == labelIdx]
+        verts, loops, face_sizes = glyph_template(labelIdx, size)
+
+        if instance:
+            # Create a point cloud which instances the glyph on each vertex
+            mesh = utils.create_mesh(points, np.zeros((0, 3), dtype=np.int32),
+                'ScatterMesh {}'.format(labelIdx))
+            glyph_mesh = utils.create_mesh(verts, loops,
+                'ScatterGlyphMesh {}'.format(labelIdx), face_sizes)
+        else:
+            # Tile the glyph vertices over all points in chunks, which
+            # avoids large temporary arrays
+            n, k = len(points), len(verts)
+            tiled_verts = np.empty((n, k, 3), dtype=np.float32)
+            for start in range(0, n, chunk_size):
+                tiled_verts[start:start + chunk_size] = \
+                    points[start:start + chunk_size, None] + \
+                    points_scales[start:start + chunk_size, None, None]*verts
+            offsets = k*np.arange(n, dtype=np.int32)
+            tiled_loops = (offsets[:, None] + loops).ravel()
+            tiled_face_sizes = np.tile(face_sizes, n)
+
+            # Create a single mesh with all glyphs of the label
+            mesh = utils.create_mesh(tiled_verts, tiled_loops,
+                'ScatterMesh {}'.format(labelIdx), tiled_face_sizes)
+            glyph_mesh = mesh
 
         # Create a object with the mesh and link it to the scene
         obj = bpy.data.objects.new('ScatterObject {}'.format(labelIdx), mesh)
         bpy.context.collection.objects.link(obj)
 
-        # Create materials for each bmesh
+        if instance:
+            # The glyph object is hidden and instanced by its parent
+            glyph = bpy.data.objects.new(
+                'ScatterGlyph {}'.format(labelIdx), glyph_mesh)
+            bpy.context.collection.objects.link(glyph)
+            glyph.parent = obj
+            obj.instance_type = 'VERTS'
+
+        # Create materials for each label
         mat = bpy.data.materials.new('ScatterMaterial {}'.format(labelIdx))
-        mat.diffuse_color = color
+        mat.diffuse_color = colors[labelIdx % len(colors)]
         # mat.diffuse_intensity = 0.5
         mat.specular_intensity = 0.0
-        obj.data.materials.append(mat)
+        glyph_mesh.materials.append(mat)
 
         objects.append(obj)
 
@@ -114,15 +403,12 @@ def create_scatter(X, y, size=0.25):
 
 
 def create_labels(X, y, labels, camera=None):
-    label_indices = set(y)
+    label_indices, centers = group_means(X, y)
     objects = []
 
     # Draw labels
-    for label_idx in label_indices:
-        center = np.sum([x for x, idx in zip(X, y) \
-            if idx == label_idx], axis=0)
-        counts = (y == label_idx).sum()
-        center = Vector(center) / counts
+    for label_idx, center in zip(label_indices, centers):
+        center = Vector(center)
 
         label = labels[label_idx]
         font_curve = bpy.data.curves.new(type="FONT", name=label)
@@ -163,23 +449,23 @@ if __name__ == '__main__':
     # Set number of frames
     bpy.context.scene.frame_end = 50
 
-    # Animate rotation of target by keyframe animation
+    # Animate rotation of target by keyframe animation with linear
+    # interpolation, where the last frame is set to one frame further to
+    # have an animation loop
     target.rotation_mode = 'AXIS_ANGLE'
-    target.rotation_axis_angle = (0, 0, 0, 1)
-    target.keyframe_insert(data_path='rotation_axis_angle', index=-1,
-        frame=bpy.context.scene.frame_start)
-    target.rotation_axis_angle = (2*pi, 0, 0, 1)
-    # Set last frame to one frame further to have an animation loop
-    target.keyframe_insert(data_path='rotation_axis_angle', index=-1,
-        frame=bpy.context.scene.frame_end + 1)
-
-    # Change each created keyframe point to linear interpolation
-    for fcurve in target.animation_data.action.fcurves:
-        for keyframe in fcurve.keyframe_points:
-            keyframe.interpolation = 'LINEAR'
+    utils.insert_keyframes(target, 'rotation_axis_angle',
+        [bpy.context.scene.frame_start, bpy.context.scene.frame_end + 1],
+        [(0, 0, 0, 1), (2*pi, 0, 0, 1)], interpolation='LINEAR')
 
     X, y, labels = load_iris()
-    create_scatter(X, y)
+
+    # Keep one point per label in each pixel sized voxel, which only has
+    # an effect for data sets much larger than the Iris data set. The kept
+    # glyphs can be scaled by the points they stand for with
+    # scales=weight_scales(weights).
+    voxel_size = pixel_size(np.linalg.norm((6, 6, 3.5)), 35, 512)
+    X_lod, y_lod, weights = decimate_points(X, y, voxel_size)
+    create_scatter(X_lod, y_lod)
     label_objects = create_labels(X, y, labels, camera)
 
     # Create a grid
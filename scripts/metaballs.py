@@ -1,10 +1,182 @@
 import bpy
+import numpy as np
 import random
 from mathutils import Vector
+import itertools as it
+import hashlib
+import os
 import utils
 
 
-def createMetaball(origin=(0, 0, 0), n=30, r0=4, r1=2.5):
+# Decomposition of a cube into six tetrahedra along the diagonal from
+# corner 0 to corner 7, where corner i is at (i & 1, i >> 1 & 1, i >> 2)
+CUBE_CORNERS = np.array([(i & 1, i >> 1 & 1, i >> 2) for i in range(8)])
+CUBE_TETRAHEDRA = np.array([(0, 1, 3, 7), (0, 3, 2, 7), (0, 2, 6, 7),
+                            (0, 6, 4, 7), (0, 4, 5, 7), (0, 5, 1, 7)])
+
+
+def tetrahedron_cases():
+    # Triangles as pairs of tetrahedron vertices for each of the 16 cases
+    # of inside vertices, with at most two triangles for each case
+    edges = np.zeros((16, 2, 3, 2), dtype=int)
+    valid = np.zeros((16, 2), dtype=bool)
+    for case in range(1, 15):
+        inside = [v for v in range(4) if case >> v & 1]
+        outside = [v for v in range(4) if not case >> v & 1]
+        if len(inside) == 2:
+            (a, b), (c, d) = inside, outside
+            edges[case] = [[(a, c), (a, d), (b, d)], [(a, c), (b, d), (b, c)]]
+            valid[case] = True
+        else:
+            lone = inside if len(inside) == 1 else outside
+            others = outside if len(inside) == 1 else inside
+            edges[case, 0] = [(lone[0], other) for other in others]
+            valid[case, 0] = True
+    return edges, valid
+
+
+TETRAHEDRON_CASES = tetrahedron_cases()
+
+
+def grid_codes(idx):
+    # Encode integer grid indices of shape (..., 3) as single integers
+    # with 20 bits per axis
+    idx = idx + (1 << 19)
+    return (idx[..., 0] << 40) | (idx[..., 1] << 20) | idx[..., 2]
+
+
+def metaball_blocks(co, radii, stiffness=2.0, resolution=0.05, block_size=16):
+    # Sparse field of the ball elements on a grid with spacing resolution,
+    # which is split into blocks of block_size^3 cells. Only the blocks
+    # overlapped by elements are evaluated, and only for these elements.
+    # Yields the grid index of the first point of each block and the field
+    # on its (block_size + 1)^3 points.
+    co = np.asarray(co, dtype=float)
+    radii = np.broadcast_to(np.asarray(radii, dtype=float), len(co))
+    lower = np.floor((co - radii[:, None]).min(axis=0) / resolution) - 1
+
+    # Spatial hash of the blocks overlapped by the bounds of each element
+    first = np.floor(((co - radii[:, None]) / resolution - lower) / block_size)
+    last = np.floor(((co + radii[:, None]) / resolution - lower) / block_size)
+    extent = (last - first).astype(int)
+    offsets = np.array(list(it.product(range(extent.max() + 1), repeat=3)))
+    overlaps = np.all(offsets[None] <= extent[:, None], axis=2)
+    elements, offset_idx = np.nonzero(overlaps)
+    blocks = (first[elements] + offsets[offset_idx]).astype(np.int64)
+    block_codes = grid_codes(blocks)
+    order = np.argsort(block_codes, kind='stable')
+    splits = np.flatnonzero(np.diff(block_codes[order])) + 1
+
+    local = np.arange(block_size + 1)
+    for group in np.split(order, splits):
+        origin = lower + blocks[group[0]]*block_size
+        centers, r2 = co[elements[group]], radii[elements[group]]**2
+        x, y, z = [((origin[i] + local)*resolution)[None, :] - centers[:, i, None]
+                   for i in range(3)]
+        d2 = x[:, :, None, None]**2 + y[:, None, :, None]**2 + z[:, None, None, :]**2
+        values = stiffness*(np.maximum(1 - d2 / r2[:, None, None, None], 0)**3)
+        yield origin.astype(np.int64), values.sum(axis=0)
+
+
+def march_block(origin, values, threshold=0.6, resolution=0.05):
+    # Marching tetrahedra on the cells of one block, returns the vertices
+    # with the key of the grid edge they lie on and the oriented triangles
+    n = values.shape[0] - 1
+    inside = values >= threshold
+    corner_values = np.stack([values[dx:dx + n, dy:dy + n, dz:dz + n]
+        for dx, dy, dz in CUBE_CORNERS], axis=-1).reshape(-1, 8)
+    corner_inside = corner_values >= threshold
+    mixed = np.flatnonzero(corner_inside.any(axis=1) & ~corner_inside.all(axis=1))
+    if len(mixed) == 0:
+        return (np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.float32),
+                np.empty((0, 3), dtype=np.int32))
+
+    # Global grid index of the corners of the cells with an intersection
+    cell_idx = np.stack(np.unravel_index(mixed, (n, n, n)), axis=-1) + origin
+    corner_idx = cell_idx[:, None] + CUBE_CORNERS
+    corner_codes = grid_codes(corner_idx)
+    corner_values = corner_values[mixed]
+
+    # Case of each tetrahedron in each cell
+    tet_idx = corner_idx[:, CUBE_TETRAHEDRA].reshape(-1, 4, 3)
+    tet_codes = corner_codes[:, CUBE_TETRAHEDRA].reshape(-1, 4)
+    tet_values = corner_values[:, CUBE_TETRAHEDRA].reshape(-1, 4)
+    tet_inside = tet_values >= threshold
+    cases = (tet_inside << np.arange(4)).sum(axis=1)
+
+    # Triangles of all tetrahedra with an intersection
+    edges, valid = TETRAHEDRON_CASES
+    tets, triangles = np.nonzero(valid[cases])
+    tri_edges = edges[cases[tets], triangles]
+    codes = np.take_along_axis(tet_codes[tets][:, None], tri_edges, axis=2)
+    field = np.take_along_axis(tet_values[tets][:, None], tri_edges, axis=2)
+    grid = tet_idx[tets][np.arange(len(tets))[:, None, None], tri_edges]*resolution
+
+    # Interpolate the vertices on the edges of the grid
+    t = ((threshold - field[..., 0]) / (field[..., 1] - field[..., 0]))[..., None]
+    positions = grid[..., 0, :] + t*(grid[..., 1, :] - grid[..., 0, :])
+
+    # Orient the triangles away from an inside vertex of the tetrahedron
+    inside_vertex = np.argmax(tet_inside[tets], axis=1)
+    inside_position = tet_idx[tets, inside_vertex]*resolution
+    normals = np.cross(positions[:, 1] - positions[:, 0],
+                       positions[:, 2] - positions[:, 0])
+    flip = np.einsum('ij,ij->i', normals,
+        positions.mean(axis=1) - inside_position) < 0
+    positions[flip] = positions[flip][:, ::-1]
+    codes[flip] = codes[flip][:, ::-1]
+
+    # Share the vertices on the same grid edge between triangles, the end
+    # of each edge differs from its start by 0 or 1 along each axis, which
+    # fits together with the start into a single integer
+    start, end = codes.min(axis=2), codes.max(axis=2)
+    diff = end - start
+    direction = (diff >> 40) | ((diff >> 20 & 1) << 1) | ((diff & 1) << 2)
+    edge_keys = ((start << 3) | direction).ravel()
+    keys, index, inverse = np.unique(edge_keys,
+        return_index=True, return_inverse=True)
+    verts = positions.reshape(-1, 3)[index].astype(np.float32)
+
+    return keys, verts, inverse.reshape(-1, 3).astype(np.int32)
+
+
+@utils.profile
+def polygonize_metaballs(co, radii, threshold=0.6, stiffness=2.0,
+                         resolution=0.05, block_size=16):
+    # Triangle mesh of the iso surface of the metaball field at the
+    # threshold, where blocks completely inside or outside are skipped
+    keys, verts, faces, num_verts = [], [], [], 0
+    for origin, values in metaball_blocks(co, radii, stiffness, resolution,
+                                          block_size):
+        inside = values >= threshold
+        if inside.any() and not inside.all():
+            block_keys, block_verts, block_faces = march_block(
+                origin, values, threshold, resolution)
+            keys.append(block_keys)
+            verts.append(block_verts)
+            faces.append(block_faces + num_verts)
+            num_verts += len(block_verts)
+
+    if not keys:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=int)
+
+    # Merge the vertices on the boundaries between blocks
+    _, index, inverse = np.unique(np.concatenate(keys),
+        return_index=True, return_inverse=True)
+    verts = np.concatenate(verts)[index]
+    faces = inverse.reshape(-1)[np.concatenate(faces)]
+
+    return verts, faces
+
+
+def metaball_elements(origin=(0, 0, 0), n=30, r0=4, seed=None):
+    # Random element locations, which are the same for the same seed
+    rng = random.Random(seed)
+    return [Vector(origin) + Vector(rng.uniform(-r0, r0) for i in range(3))
+            for i in range(n)]
+
+
+def createMetaball(origin=(0, 0, 0), n=30, r0=4, r1=2.5, seed=None):
     metaball = bpy.data.metaballs.new('MetaBall')
     obj = bpy.data.objects.new('MetaBallObject', metaball)
     bpy.context.collection.objects.link(obj)
@@ -12,9 +184,7 @@ def createMetaball(origin=(0, 0, 0), n=30, r0=4, r1=2.5):
     metaball.resolution = 0.2
     metaball.render_resolution = 0.05
 
-    for i in range(n):
-        location = Vector(origin) + Vector(random.uniform(-r0, r0) for i in range(3))
-
+    for location in metaball_elements(origin, n, r0, seed):
         element = metaball.elements.new()
         element.co = location
         element.radius = r1
@@ -22,6 +192,60 @@ def createMetaball(origin=(0, 0, 0), n=30, r0=4, r1=2.5):
     return obj
 
 
+def evict_metaball_cache(max_size):
+    # Remove the least recently used meshes until the cache folder holds
+    # at most max_size bytes of metaball meshes
+    entries = []
+    for filename in os.listdir('cache'):
+        if filename.startswith('metaball-') and filename.endswith('.npz'):
+            stat = os.stat(os.path.join('cache', filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, filename in sorted(entries):
+        if size <= max_size:
+            break
+        os.remove(os.path.join('cache', filename))
+        size -= entry_size
+
+
+def createMetaballMesh(origin=(0, 0, 0), n=30, r0=4, r1=2.5, seed=0,
+                       threshold=0.6, stiffness=2.0, resolution=0.05,
+                       cache=True, max_size=2**28):
+    # Polygonize the seeded metaball elements into a regular mesh object,
+    # which is stored in the cache folder and keyed by the elements and
+    # all parameters of the field. The least recently used meshes are
+    # removed above max_size bytes.
+    co = np.array(metaball_elements(origin, n, r0, seed))
+    path = None
+    if cache:
+        key = np.concatenate((co.ravel(),
+            [r1, threshold, stiffness, resolution])).tobytes()
+        digest = hashlib.sha1(key).hexdigest()[:16]
+        path = os.path.join('cache', 'metaball-{}.npz'.format(digest))
+
+    if path is not None and os.path.exists(path):
+        with np.load(path) as arrays:
+            verts, faces = arrays['verts'], arrays['faces']
+        # Mark the mesh as recently used for the eviction
+        os.utime(path)
+    else:
+        verts, faces = polygonize_metaballs(co, r1, threshold, stiffness,
+                                            resolution)
+        if path is not None:
+            if not os.path.exists('cache'):
+                os.makedirs('cache')
+            # The rename makes sure that an interrupted write never leaves
+            # a broken mesh in the cache
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, verts=verts, faces=faces)
+            os.replace(path + '.tmp', path)
+            evict_metaball_cache(max_size)
+
+    obj = utils.arrays_to_object(verts, faces, 'MetaBallObject')
+    utils.set_smooth(obj)
+    return obj
+
+
 if __name__ == '__main__':
     # Remove all elements
     utils.remove_all()
@@ -31,10 +255,14 @@ if __name__ == '__main__':
     camera = utils.create_camera((-10, -10, 10), target)
 
     # Create lights
-    utils.rainbowLights(10, 100, 3, energy=100)
+    utils.rainbow_lights(10, 100, 3, energy=100)
 
-    # Create metaball
-    obj = createMetaball()
+    # Create metaball, either evaluated by Blender or polygonized with Numpy
+    use_mesh = False
+    if use_mesh:
+        obj = createMetaballMesh()
+    else:
+        obj = createMetaball()
     
     # Create material
     mat = utils.create_material(metalic=0.5)
@@ -1,58 +1,67 @@
 import bpy
-from math import sin, cos, pi
+import numpy as np
+from math import pi
 TAU = 2*pi
 import utils
 
 
-# Create a function for the u, v surface parameterization from r0 and r1
+# Create a function for the u, v surface parameterization from r0 and r1,
+# which works for single values as well as for whole arrays of u and v
 def torus_surface(r0, r1):
     def surface(u, v):
-        point = ((r0 + r1*cos(TAU*v))*cos(TAU*u), \
-                 (r0 + r1*cos(TAU*v))*sin(TAU*u), \
-                  r1*sin(TAU*v))
+        point = ((r0 + r1*np.cos(TAU*v))*np.cos(TAU*u), \
+                 (r0 + r1*np.cos(TAU*v))*np.sin(TAU*u), \
+                  r1*np.sin(TAU*v))
         return point
     return surface
 
 
+# Evaluate a surface parameterization on the u, v grid arrays
+def evaluate_surface(surface, u, v):
+    try:
+        # Evaluate all grid points at once for vectorized parameterizations
+        points = np.stack(np.broadcast_arrays(*surface(u, v)), axis=-1)
+        if points.shape != u.shape + (3,):
+            raise ValueError('Surface does not return one point per grid point')
+    except (TypeError, ValueError):
+        # Fall back to evaluating scalar parameterizations point by point
+        points = np.array([surface(u_i, v_i)
+            for u_i, v_i in zip(u.ravel().tolist(), v.ravel().tolist())])
+
+    return points.reshape(-1, 3)
+
+
 # Create an object from a surface parameterization
+@utils.profile
 def create_surface(surface, n=10, m=10, origin=(0,0,0), name='Surface'):
-    verts = list()
-    faces = list()
-
-    # Create uniform n by m grid
-    for col in range(m):
-        for row in range(n):
-            u = row / n
-            v = col / m
-
-            # Surface parameterization
-            point = surface(u, v)
-            verts.append(point)
-
-            # Connect first and last vertices on the u and v axis
-            row_next = (row + 1) % n
-            col_next = (col + 1) % m
-            # Indices for each qued
-            faces.append((
-                (col*n) + row_next, 
-                (col_next*n) + row_next, 
-                (col_next*n) + row, 
-                (col*n) + row
-            ))
+    # Create uniform n by m grid, where the vertex index is col*n + row
+    col, row = np.meshgrid(np.arange(m), np.arange(n), indexing='ij')
+    u = row / n
+    v = col / m
+
+    # Surface parameterization
+    verts = evaluate_surface(surface, u, v)
+
+    # Connect first and last vertices on the u and v axis
+    row_next = (row + 1) % n
+    col_next = (col + 1) % m
+    # Indices for each quad
+    faces = np.stack((
+        (col*n) + row_next,
+        (col_next*n) + row_next,
+        (col_next*n) + row,
+        (col*n) + row
+    ), axis=-1).reshape(-1, 4)
 
     print('verts : ' + str(len(verts)))
     print('faces : ' + str(len(faces)))
 
-    # Create mesh and object
-    mesh = bpy.data.meshes.new(name+'Mesh')
+    # Create mesh from given verts and faces
+    mesh = utils.create_mesh(verts, faces, name+'Mesh')
     obj  = bpy.data.objects.new(name, mesh)
     obj.location = origin
     # Link object to scene
     bpy.context.collection.objects.link(obj)
-    # Create mesh from given verts and faces
-    mesh.from_pydata(verts, [], faces)
-    #Update mesh with new data
-    mesh.update(calc_edges=True)
     return obj
 
 
@@ -68,7 +77,7 @@ if __name__ == '__main__':
     bpy.context.scene.cursor.location = (0, 0, 0)
 
     # Create lamps
-    utils.rainbowLights(10, 100, 3, energy=300)
+    utils.rainbow_lights(10, 100, 3, energy=300)
 
     # Create object
     obj = create_surface(torus_surface(4, 2), 20, 20)
@@ -1,8 +1,9 @@
 import bpy
 import bmesh
 import numpy as np
-from mathutils import Vector, Matrix
-from math import sqrt, pi, sin, cos
+from mathutils import Matrix
+from math import sqrt, pi
+import hashlib
 import utils
 
 TAU = 2*pi
@@ -12,22 +13,26 @@ GOLDEN_ANGLE = pi*(3 - sqrt(5))
 
 # Get a frame of a vector (tangent, normal and binormal vectors)
 # https://en.wikipedia.org/wiki/Frenet%E2%80%93Serret_formulas
+# Works on a single vector as well as on arrays of vectors of shape (..., 3)
 def getTNBfromVector(v):
-    v = Vector(v)
-    N = v.normalized()
-    B = N.cross((0, 0, -1))
-    if(B.length == 0):
-        B, T = Vector((1, 0, 0)), Vector((0, 1, 0))
-    else:
-        B.normalize()
-        T = N.cross(B).normalized()
+    v = np.asarray(v, dtype=float)
+    N = v / np.linalg.norm(v, axis=-1, keepdims=True)
+    B = np.cross(N, (0, 0, -1))
+    length = np.linalg.norm(B, axis=-1, keepdims=True)
+
+    # Use a fixed frame for vectors along the z-axis
+    vertical = length == 0
+    B = np.where(vertical, (1, 0, 0), B / np.where(vertical, 1, length))
+    T = np.cross(N, B)
+    T = np.where(vertical, (0, 1, 0),
+        T / np.linalg.norm(T, axis=-1, keepdims=True))
 
     return T, N, B
 
 
 class PhyllotaxisFlower():
-    def __init__(self, scene):
-        self.n, self.m = 40, 30
+    def __init__(self, scene, cache=False, n=40, m=30):
+        self.n, self.m = n, m
         self.r0, self.r1, self.r2 = 10, 2, 2
         self.h0, self.h1 = 10, 3
         self.frames = scene.frame_end - scene.frame_start + 1
@@ -36,16 +41,27 @@ class PhyllotaxisFlower():
         self.offset = (self.frames * GOLDEN_ANGLE) % TAU
         if self.offset > pi: self.offset -= TAU
 
-        # Create object
-        mesh = bpy.data.meshes.new('PhyllotaxisFlower')
+        # Create the template cone and tile its faces for all n*m cones,
+        # the topology stays the same for all frames
+        self.template_verts, loops, face_sizes = self.template()
+        offsets = len(self.template_verts)*np.arange(self.n*self.m)
+        loops = (offsets[:, None] + loops).ravel()
+        face_sizes = np.tile(face_sizes, self.n*self.m)
+
+        # Optionally cache the vertex positions of each frame
+        self.cache = None
+        if cache:
+            params = dict(n=self.n, m=self.m, r=(self.r0, self.r1, self.r2),
+                h=(self.h0, self.h1), frames=self.frames)
+            self.cache = utils.FrameCache('PhyllotaxisFlower', params,
+                (self.n*self.m*len(self.template_verts), 3),
+                self.frames + 1, version=self.cache_version())
+
+        # Create object and mesh
+        mesh = utils.create_mesh(self.geometry(), loops,
+            'PhyllotaxisFlower', face_sizes)
         self.obj = bpy.data.objects.new('PhyllotaxisFlower', mesh)
 
-        # Create mesh
-        bm = self.geometry()
-        bm.to_mesh(mesh)
-        mesh.update()
-        bm.free()
-
         # Link object to scene
         scene.collection.objects.link(self.obj)
 
@@ -59,57 +75,82 @@ class PhyllotaxisFlower():
         if(frame < 1): frame = 1
         if(frame >= self.frames): frame = self.frames + 1
 
+        # Only update the vertex positions of the existing mesh
         mesh = self.obj.data
-        bm = self.geometry(frame - 1)
-        bm.to_mesh(mesh)
+        if self.cache is not None:
+            verts = self.cache.get(frame - 1, self.geometry)
+        else:
+            verts = self.geometry(frame - 1)
+        mesh.vertices.foreach_set('co', verts.astype(np.float32).ravel())
         mesh.update()
-        bm.free()
-
-
-    def geometry(self, frame=0):
-        t = frame / self.frames
-        Rot = Matrix.Rotation(0.5*pi, 4, 'Y')
-        bm = bmesh.new()
 
-        for i in range(self.n):
-            t0 = i / self.n
-            r0, theta = t0*self.r0, i*GOLDEN_ANGLE - frame*GOLDEN_ANGLE + t*self.offset
 
-            x = r0*cos(theta)
-            y = r0*sin(theta)
-            z = self.h0/2 - (self.h0 / (self.r0*self.r0))*r0*r0
-            p0 = Vector((x, y, z))
+    def cache_version(self):
+        # Cached frames are only valid for the same template and geometry
+        # code, so both are hashed into the key of the frame cache
+        geometry = PhyllotaxisFlower.geometry
+        code = getattr(geometry, '__wrapped__', geometry).__code__
+        h = hashlib.sha1(self.template_verts.tobytes())
+        h.update(code.co_code)
+        h.update(repr(code.co_consts).encode('utf-8'))
+        return h.hexdigest()
 
-            T0, N0, B0 = getTNBfromVector(p0)
-            M0 = Matrix([T0, B0, N0]).to_4x4().transposed()
 
-            for j in range(self.m):
-                t1 = j / self.m
-                t2 = 0.4 + 0.6*t0
-                r1, theta = t2*t1*self.r1, j*GOLDEN_ANGLE #- frame*goldenAngle + t*self.offset
+    def template(self):
+        # Cone with unit diameter which is scaled and placed for each petal
+        bm = bmesh.new()
+        bmesh.ops.create_cone(bm,
+            cap_ends=True, segments=6,
+            diameter1=1, diameter2=1,
+            depth=0.1)
+        verts, loops, face_sizes = utils.bmesh_to_arrays(bm)
+        bm.free()
 
-                x = r1*cos(theta)
-                y = r1*sin(theta)
-                z = self.h1 - (self.h1 / (self.r1*self.r1))*r1*r1
-                p1 = Vector((x, y, z))
-                T1, N1, B1 = getTNBfromVector(p1)
-                M1 = Matrix([T1, B1, N1]).to_4x4().transposed()
+        return verts, loops, face_sizes
 
-                p = p0 + (M0 @ p1)
-                r2 = t2*t1*self.r2
 
-                T = Matrix.Translation(p)
-                bmesh.ops.create_cone(bm,
-                    cap_ends=True, segments=6,
-                    diameter1=r2, diameter2=r2,
-                    depth=0.1*r2, matrix=T @ M0 @ M1 @ Rot)
-        return bm
+    @utils.profile
+    def geometry(self, frame=0):
+        t = frame / self.frames
+        Rot = np.array(Matrix.Rotation(0.5*pi, 3, 'Y'))
+
+        # Points on the main surface for each i of shape (n, 3)
+        t0 = np.arange(self.n) / self.n
+        r0 = t0*self.r0
+        theta = np.arange(self.n)*GOLDEN_ANGLE - frame*GOLDEN_ANGLE + t*self.offset
+        p0 = np.stack((
+            r0*np.cos(theta),
+            r0*np.sin(theta),
+            self.h0/2 - (self.h0 / (self.r0*self.r0))*r0*r0), axis=-1)
+        T0, N0, B0 = getTNBfromVector(p0)
+        M0 = np.stack((T0, B0, N0), axis=-1)
+
+        # Points on the petal surfaces for each i, j of shape (n, m, 3)
+        t1 = np.arange(self.m) / self.m
+        t2 = 0.4 + 0.6*t0
+        r1 = t2[:, None]*t1[None, :]*self.r1
+        theta = np.arange(self.m)*GOLDEN_ANGLE #- frame*goldenAngle + t*self.offset
+        p1 = np.stack((
+            r1*np.cos(theta),
+            r1*np.sin(theta),
+            self.h1 - (self.h1 / (self.r1*self.r1))*r1*r1), axis=-1)
+        T1, N1, B1 = getTNBfromVector(p1)
+        M1 = np.stack((T1, B1, N1), axis=-1)
+
+        p = p0[:, None] + np.einsum('iab,ijb->ija', M0, p1)
+        r2 = t2[:, None]*t1[None, :]*self.r2
+
+        # Batched transformation matrices of shape (n, m, 3, 3) applied
+        # to the template cone, which results in (n*m*k, 3) vertices
+        M = (M0[:, None] @ M1 @ Rot)*r2[:, :, None, None]
+        verts = np.einsum('ijab,kb->ijka', M, self.template_verts)
+        verts += p[:, :, None]
+        return verts.reshape(-1, 3)
 
 
 if __name__ == '__main__':
     # Remove all elements
-    bpy.ops.object.select_all(action="SELECT")
-    bpy.ops.object.delete(use_global=False)
+    utils.remove_all()
 
     # Creata phyllotaxis flower
     flower = PhyllotaxisFlower(bpy.context.scene)
@@ -142,3 +183,7 @@ if __name__ == '__main__':
         render_engine='CYCLES',
         animation=True,
         frame_end=50)
+
+    # Show how often frames were reused from the cache
+    if flower.cache is not None:
+        print(flower.cache.stats())
@@ -1,7 +1,7 @@
 import bpy
-from math import pi, sin, cos
+import numpy as np
+from math import pi
 import utils
-import os
 
 
 if __name__ == '__main__':
@@ -26,20 +26,16 @@ if __name__ == '__main__':
     empty = bpy.data.objects.new('Empty', None)
     bpy.context.scene.collection.objects.link(empty)
 
-    # Animate empty with keyframe animation
-    # keyframe approach adapted from: http://blenderscripting.blogspot.co.at/2011/05/inspired-by-post-on-ba-it-just-so.html
-    for frame in range(1, num_frames):
-        t = frame / num_frames
-        x = 0.7*cos(2*pi*t) + 1
-        y = 0.7*sin(2*pi*t)
-        z = 0.4*sin(2*pi*t)
-        empty.location = (x, y, z)
-        empty.keyframe_insert(data_path="location", index=-1, frame=frame)
-
-    # Change each created keyframe point to linear interpolation
-    #for fcurve in empty.animation_data.action.fcurves:
-    #    for keyframe in fcurve.keyframe_points:
-    #        keyframe.interpolation = 'LINEAR'
+    # Animate empty with keyframe animation, all keyframes are inserted at
+    # once from an array with one location for each frame
+    frames = np.arange(1, num_frames)
+    t = frames / num_frames
+    locations = np.stack((
+        0.7*np.cos(2*pi*t) + 1,
+        0.7*np.sin(2*pi*t),
+        0.4*np.sin(2*pi*t)), axis=-1)
+    utils.insert_keyframes(empty, 'location', frames, locations,
+        interpolation='BEZIER')
 
     # Apply subsurf modifier
     subsurf = obj.modifiers.new('Subsurf', 'SUBSURF')
@@ -1,32 +1,12 @@
 import bpy
-import colorsys
-from math import sin, cos, pi
+from math import pi
 from mathutils import Euler
-TAU = 2*pi
-
-
-def rainbow_lights(r=5, n=100, freq=2, energy=100):
-    for i in range(n):
-        t = float(i)/float(n)
-        pos = (r*sin(TAU*t), r*cos(TAU*t), r*sin(freq*TAU*t))
-
-        # Create lamp
-        bpy.ops.object.add(type='LIGHT', location=pos)
-        obj = bpy.context.object
-        obj.data.type = 'POINT'
-
-        # Apply gamma correction for Blender
-        color = tuple(pow(c, 2.2) for c in colorsys.hsv_to_rgb(t, 0.6, 1))
-
-        # Set HSV color and lamp energy
-        obj.data.color = color
-        obj.data.energy = energy
+import utils
 
 
 if __name__ == '__main__':
     # Remove all elements
-    bpy.ops.object.select_all(action="SELECT")
-    bpy.ops.object.delete(use_global=False)
+    utils.remove_all()
 
     # Set cursor to (0, 0, 0)
     bpy.context.scene.cursor.location = (0, 0, 0)
@@ -41,7 +21,7 @@ if __name__ == '__main__':
     bpy.context.scene.camera = camera
 
     # Create lamps
-    rainbow_lights(5, 100, 2, energy=100)
+    utils.rainbow_lights(5, 100, 2, energy=100)
 
     # Create object
     bpy.ops.mesh.primitive_ico_sphere_add(
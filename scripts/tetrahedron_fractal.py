@@ -38,19 +38,45 @@ def recursive_tetrahedron(bm, points, level=0):
             bmesh.ops.recalc_face_normals(bm, faces=faces)
 
 
+@utils.profile
+def tetrahedron_fractal(points, level=0, weld=True):
+    # Corners of all tetrahedra with the shape (num_tetras, 4, 3)
+    tetras = np.asarray(points, dtype=float).reshape(1, 4, 3)
+
+    # Each subdivision replaces every tetrahedron by the four tetrahedra
+    # spanned by one corner and the midpoints of its adjacent edges,
+    # which yields 4^(level + 1) tetrahedra as in recursive_tetrahedron
+    for i in range(level + 1):
+        tetras = 0.5*(tetras[:, :, None] + tetras[:, None, :])
+        tetras = tetras.reshape(-1, 4, 3)
+
+    # Outward facing triangles for a positively oriented tetrahedron,
+    # all sub tetrahedra are scaled copies and share the same orientation
+    faces = np.array([(0, 2, 1), (0, 1, 3), (0, 3, 2), (1, 2, 3)])
+    base = tetras[0]
+    if np.linalg.det(base[1:] - base[0]) < 0:
+        faces = faces[:, ::-1]
+    offsets = 4*np.arange(len(tetras))
+    faces = (offsets[:, None, None] + faces).reshape(-1, 3)
+    verts = tetras.reshape(-1, 3)
+
+    # Merge the corners shared by touching tetrahedra
+    if weld:
+        verts, faces = utils.weld_vertices(verts, faces)
+
+    return verts, faces
+
+
 if __name__ == '__main__':
     # Remove all elements
     utils.remove_all()
 
     # Creata fractal tetrahedron
-    bm = bmesh.new()
     tetrahedron_base_points = tetrahedron_points(5)
-    recursive_tetrahedron(bm, tetrahedron_base_points, level=4)
+    verts, faces = tetrahedron_fractal(tetrahedron_base_points, level=4)
 
-    # Create obj and mesh from bmesh object
-    mesh = bpy.data.meshes.new("TetrahedronMesh")
-    bm.to_mesh(mesh)
-    bm.free()
+    # Create obj and mesh from vertex and face arrays
+    mesh = utils.create_mesh(verts, faces, "TetrahedronMesh")
     obj = bpy.data.objects.new("Tetrahedron", mesh)
     bpy.context.collection.objects.link(obj)
 
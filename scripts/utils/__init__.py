@@ -1,20 +1,32 @@
 import bpy
 import bmesh
+import numpy as np
 from math import sin, cos, pi
 TAU = 2*pi
 import colorsys
 import os
 
+from .profiling import stage, profile
+from . import profiling
+from .memory import datablock_stats, memory_stage, purge_orphans, \
+    leak_detector, TRACK_LEAKS
+from .frame_cache import FrameCache
+from .material_cache import MaterialCache
+from .render_cache import RenderCache, scene_fingerprint
+from .telemetry import RenderTelemetry
+from . import rendering
+
+# Seed the random generators, so that the render worker processes which
+# run the script again build the same scene as this process
+rendering.seed_random()
+
 
 def remove_object(obj):
-    if obj.type == 'MESH':
-        if obj.data.name in bpy.data.meshes:
-            bpy.data.meshes.remove(obj.data)
-        if obj.name in bpy.context.scene.objects:
-            bpy.context.scene.objects.unlink(obj)
-        bpy.data.objects.remove(obj)
-    else:
-        raise NotImplementedError('Other types not implemented yet besides \'MESH\'')
+    # Remove the object and its data if no other object uses it
+    data = obj.data
+    bpy.data.objects.remove(obj)
+    if data is not None and data.users == 0:
+        bpy.data.batch_remove([data])
 
 
 def track_to_constraint(obj, target):
@@ -91,51 +103,296 @@ def set_smooth(obj, level=None, smooth=True):
         p.use_smooth = smooth
 
 
-def rainbow_lights(r=5, n=100, freq=2, energy=0.1):
-    for i in range(n):
-        t = float(i)/float(n)
-        pos = (r*sin(TAU*t), r*cos(TAU*t), r*sin(freq*TAU*t))
+def rainbow_ring(r=5, n=100, freq=2, num_colors=None):
+    # Positions and gamma corrected colors along the rainbow ring
+    t = np.arange(n) / n
+    points = np.stack((
+        r*np.sin(TAU*t),
+        r*np.cos(TAU*t),
+        r*np.sin(freq*TAU*t)), axis=-1)
+
+    # Quantize the hues so that lights can share the same color
+    hues = t if num_colors is None else np.floor(t*num_colors) / num_colors
+
+    # Apply gamma correction for Blender
+    colors = np.array([colorsys.hsv_to_rgb(h, 0.6, 1) for h in hues.tolist()])
+    colors = np.power(colors, 2.2)
+
+    return points, colors
+
+
+def rainbow_lights(r=5, n=100, freq=2, energy=0.1, num_colors=None,
+                   emissive_ring=False, thickness=0.05):
+    if emissive_ring:
+        return rainbow_ring_mesh(r, n, freq, energy, num_colors, thickness)
+
+    points, colors = rainbow_ring(r, n, freq, num_colors)
+
+    # Create the lights with bpy.data instead of bpy.ops, which avoids an
+    # operator call, undo push and scene update for every single light
+    lights, objects = {}, []
+    collection = bpy.context.collection
+    for point, color in zip(points.tolist(), colors.tolist()):
+        # Lights with the same color share one light data-block
+        key = tuple(round(c, 6) for c in color)
+        if key not in lights:
+            light = bpy.data.lights.new('RainbowLight', 'POINT')
+            light.color = color
+            light.energy = energy
+            lights[key] = light
+
+        obj = bpy.data.objects.new('RainbowLight', lights[key])
+        obj.location = point
+        collection.objects.link(obj)
+        objects.append(obj)
+
+    return objects
+
+
+def rainbow_ring_mesh(r=5, n=100, freq=2, energy=0.1, num_colors=None,
+                      thickness=0.05, sides=8):
+    # Emissive tube along the rainbow ring, where n only sets the
+    # resolution, so that the light sampling cost does not grow with n
+    n = max(n, 64)
+    points, colors = rainbow_ring(r, n, freq, num_colors)
+
+    # Frame along the ring, the tangent is never parallel to the z-axis
+    tangents = np.roll(points, -1, axis=0) - np.roll(points, 1, axis=0)
+    tangents /= np.linalg.norm(tangents, axis=1)[:, None]
+    normals = np.cross(tangents, (0, 0, 1))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    binormals = np.cross(tangents, normals)
+
+    # Circular cross section around each point, vertex index is i*sides + j
+    angles = TAU*np.arange(sides) / sides
+    verts = points[:, None] + thickness*(
+        np.cos(angles)[None, :, None]*normals[:, None] +
+        np.sin(angles)[None, :, None]*binormals[:, None])
+
+    # Quads connecting neighboring cross sections, wrapped in both directions
+    i, j = np.meshgrid(np.arange(n), np.arange(sides), indexing='ij')
+    i_next, j_next = (i + 1) % n, (j + 1) % sides
+    faces = np.stack((
+        i*sides + j,
+        i*sides + j_next,
+        i_next*sides + j_next,
+        i_next*sides + j), axis=-1).reshape(-1, 4)
+
+    mesh = create_mesh(verts.reshape(-1, 3), faces, 'RainbowRingMesh')
+
+    # Store the light colors as vertex color attribute
+    vertex_colors = np.ones((n, sides, 4))
+    vertex_colors[:, :, :3] = colors[:, None]
+    attribute = mesh.attributes.new('Color', 'FLOAT_COLOR', 'POINT')
+    attribute.data.foreach_set('color', vertex_colors.ravel())
+
+    # Emission strength which distributes the energy of the n lights
+    # roughly over the surface of the tube
+    length = np.linalg.norm(np.roll(points, -1, axis=0) - points, axis=1).sum()
+    area = TAU*thickness*length
+
+    mat = bpy.data.materials.new('RainbowRingMaterial')
+    mat.use_nodes = True
+    nodes, links = mat.node_tree.nodes, mat.node_tree.links
+    output = next(node for node in nodes if node.type == 'OUTPUT_MATERIAL')
+    attribute_node = nodes.new('ShaderNodeAttribute')
+    attribute_node.attribute_name = 'Color'
+    emission_node = nodes.new('ShaderNodeEmission')
+    emission_node.inputs['Strength'].default_value = energy*n / area
+    links.new(emission_node.inputs['Color'], attribute_node.outputs['Color'])
+    links.new(output.inputs['Surface'], emission_node.outputs[0])
+    mesh.materials.append(mat)
+
+    obj = bpy.data.objects.new('RainbowRing', mesh)
+    bpy.context.collection.objects.link(obj)
 
-        # Create lamp
-        bpy.ops.object.add(type='LIGHT', location=pos)
-        obj = bpy.context.object
-        obj.data.type = 'POINT'
+    return obj
 
-        # Apply gamma correction for Blender
-        color = tuple(pow(c, 2.2) for c in colorsys.hsv_to_rgb(t, 0.6, 1))
 
-        # Set HSV color and lamp energy
-        obj.data.color = color
-        obj.data.energy = energy
+def insert_keyframes(obj, data_path, frames, values, interpolation='LINEAR'):
+    # Insert the (n_frames, k) values as keyframes of the data path at once
+    values = np.asarray(values, dtype=np.float32)
+    if values.ndim == 1:
+        values = values[:, None]
+    co = np.empty((len(values), 2), dtype=np.float32)
+    co[:, 0] = frames
+
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    if obj.animation_data.action is None:
+        obj.animation_data.action = bpy.data.actions.new(obj.name + 'Action')
+    fcurves = obj.animation_data.action.fcurves
+
+    # Enum properties are set by their integer value
+    interpolation = bpy.types.Keyframe.bl_rna.properties['interpolation'] \
+        .enum_items[interpolation].value
+    interpolations = np.full(len(values), interpolation, dtype=np.int32)
+
+    curves = []
+    for index in range(values.shape[1]):
+        fcurve = fcurves.find(data_path, index=index)
+        if fcurve is None:
+            fcurve = fcurves.new(data_path, index=index)
+        keyframe_points = fcurve.keyframe_points
+
+        # Keep the existing keyframe points of the F-curve
+        num_existing = len(keyframe_points)
+        existing_co = np.empty(2*num_existing, dtype=np.float32)
+        existing_interpolations = np.empty(num_existing, dtype=np.int32)
+        keyframe_points.foreach_get('co', existing_co)
+        keyframe_points.foreach_get('interpolation', existing_interpolations)
+
+        # Merge the keyframes by frame, where the last value of a frame
+        # replaces the earlier ones and new values replace existing ones
+        co[:, 1] = values[:, index]
+        all_co = np.concatenate((existing_co.reshape(-1, 2), co))
+        all_interpolations = np.concatenate(
+            (existing_interpolations, interpolations))
+        _, last = np.unique(all_co[::-1, 0], return_index=True)
+        keep = len(all_co) - 1 - last
+
+        # Resize the keyframe points and fill them with buffer setters
+        if len(keep) > num_existing:
+            keyframe_points.add(len(keep) - num_existing)
+        for _ in range(num_existing - len(keep)):
+            keyframe_points.remove(keyframe_points[-1], fast=True)
+        keyframe_points.foreach_set('co', all_co[keep].ravel())
+        keyframe_points.foreach_set('interpolation', all_interpolations[keep])
+        fcurve.update()
+        curves.append(fcurve)
+
+    return curves
+
+
+# Empty meshes of removed objects which are reused by new_mesh
+mesh_pool = []
+
+
+def new_mesh(name='Mesh'):
+    # New mesh data-block, which reuses a recycled mesh if there is one
+    while mesh_pool:
+        mesh = mesh_pool.pop()
+        try:
+            mesh.use_fake_user = False
+        except ReferenceError:
+            # The mesh was freed in the meantime, e.g. by loading a file
+            continue
+        mesh.name = name
+        return mesh
+    return bpy.data.meshes.new(name)
+
+
+def clear_mesh_pool():
+    # Release the recycled meshes, which are kept by their fake user
+    meshes = []
+    for mesh in mesh_pool:
+        try:
+            mesh.use_fake_user = False
+        except ReferenceError:
+            continue
+        if mesh.users == 0:
+            meshes.append(mesh)
+    mesh_pool.clear()
+    bpy.data.batch_remove(meshes)
+    return len(meshes)
+
+
+def reset_scene(type=None, collection=None, recycle_meshes=False):
+    # Remove the objects of the scene, or of a collection, and optionally
+    # only of the given type(s) directly from bpy.data. This needs no
+    # selection or context, pushes no undo steps and runs in linear time.
+    if collection is None:
+        objects = bpy.context.scene.objects
+    else:
+        if isinstance(collection, str):
+            collection = bpy.data.collections[collection]
+        objects = collection.all_objects
+    if type is not None:
+        types = {type} if isinstance(type, str) else set(type)
+        objects = [obj for obj in objects if obj.type in types]
+    else:
+        objects = list(objects)
+
+    data = {obj.data.as_pointer(): obj.data
+            for obj in objects if obj.data is not None}
+    materials = {slot.material.as_pointer(): slot.material
+                 for obj in objects for slot in obj.material_slots
+                 if slot.material is not None}
+    bpy.data.batch_remove(objects)
+
+    # Remove the object data which is not used by other objects anymore,
+    # empty meshes can be kept with a fake user for new_mesh instead
+    orphans = []
+    for block in data.values():
+        if block.users > 0:
+            continue
+        if recycle_meshes and isinstance(block, bpy.types.Mesh):
+            block.clear_geometry()
+            block.materials.clear()
+            block.use_fake_user = True
+            mesh_pool.append(block)
+        else:
+            orphans.append(block)
+    bpy.data.batch_remove(orphans)
+
+    # Remove the materials of the objects which are not used anymore and
+    # evict the entries of removed or unused materials from the cache
+    bpy.data.batch_remove([mat for mat in materials.values()
+                           if mat.users == 0 and not mat.use_fake_user])
+    material_cache.evict(remove=False)
 
+    return len(objects)
 
-def remove_all(type=None):
+
+def remove_all(type=None, recycle_meshes=False, purge=False):
     # Possible type:
     # "MESH", "CURVE", "SURFACE", "META", "FONT", "ARMATURE",
     # "LATTICE", "EMPTY", "CAMERA", "LIGHT"
-    if type:
-        bpy.ops.object.select_all(action='DESELECT')
-        bpy.ops.object.select_by_type(type=type)
-        bpy.ops.object.delete()
-    else:
-        # Remove all elements in scene
-        bpy.ops.object.select_all(action="SELECT")
-        bpy.ops.object.delete(use_global=False)
+    reset_scene(type, recycle_meshes=recycle_meshes)
+    if not recycle_meshes:
+        clear_mesh_pool()
 
+    # Optionally remove all data-blocks of the session which are left
+    # without users, and check whether data-blocks pile up between runs
+    if purge:
+        purge_orphans()
+    if TRACK_LEAKS:
+        leak_detector.snapshot()
+        leak_detector.report()
+
+
+# Materials shared between create_material calls with the same inputs
+material_cache = MaterialCache()
 
-def create_material(base_color=(1, 1, 1, 1), metalic=0.0, roughness=0.5):
-    mat = bpy.data.materials.new('Material')
 
+def create_material(base_color=(1, 1, 1, 1), metalic=0.0, roughness=0.5,
+                    inputs=None, cache=False):
+    # Principled BSDF material, where inputs sets further node inputs by
+    # name. With cache an existing material with the same inputs within
+    # the tolerance is returned, so each distinct material is compiled
+    # only once. Such a material is shared and must not be changed.
     if len(base_color) == 3:
         base_color = list(base_color)
         base_color.append(1)
 
+    params = dict(inputs or {})
+    params.update(base_color=base_color, metalic=metalic, roughness=roughness)
+    if cache:
+        mat = material_cache.get(params)
+        if mat is not None:
+            return mat
+
+    mat = bpy.data.materials.new('Material')
     mat.use_nodes = True
     node = mat.node_tree.nodes[0]
     node.inputs[0].default_value = base_color
     node.inputs[4].default_value = metalic
     node.inputs[7].default_value = roughness
+    for name, value in (inputs or {}).items():
+        node.inputs[name].default_value = value
 
+    if cache:
+        material_cache.put(params, mat)
     return mat 
 
 
@@ -151,7 +408,13 @@ def render(
     resolution_percentage=100,
     animation=False,
     frame_end=None,
-    render_engine='CYCLES'
+    render_engine='CYCLES',
+    workers=1,
+    threads=None,
+    tiles=None,
+    cache=False,
+    cache_size=2**30,
+    telemetry=None
 ):
     scene = bpy.context.scene
     scene.render.resolution_x = resolution_x
@@ -173,21 +436,163 @@ def render(
             scene.render.filepath = os.path.join(
                 render_folder,
                 render_name)
-            bpy.ops.render.render(animation=True)
+            manifest_path = os.environ.get('BLENDER_RENDER_MANIFEST',
+                os.path.join(render_folder, render_name + '_manifest.jsonl'))
+            # Per-frame telemetry of the frames rendered in this process
+            log = None
+            if telemetry is not None:
+                log = RenderTelemetry(os.path.join(render_folder, telemetry))
+
+            frames = rendering.worker_frames()
+            if frames is not None:
+                # Render the frames assigned to this worker process
+                if log is not None:
+                    log.start(len(frames))
+                rendering.render_frames(scene, frames, manifest_path,
+                    int(os.environ.get(rendering.WORKER_VARIABLE, 0)))
+            elif cache:
+                # Copy unchanged frames from the cache and render the rest
+                render_cache = RenderCache(max_size=cache_size)
+                keys = render_cache.restore_frames(scene)
+                if log is not None:
+                    log.start(len(keys))
+                if workers > 1:
+                    rendering.render_animation_parallel(
+                        scene, workers, threads, manifest_path)
+                    if log is not None:
+                        log.collect()
+                else:
+                    rendering.render_frames(scene, sorted(keys), manifest_path)
+                render_cache.store_frames(scene, keys)
+                print('Render cache:', render_cache.stats())
+            elif workers > 1:
+                # Split the animation across background Blender processes,
+                # which write their own telemetry logs
+                if log is not None:
+                    log.start(len(range(scene.frame_start,
+                        scene.frame_end + 1, scene.frame_step)))
+                rendering.render_animation_parallel(
+                    scene, workers, threads, manifest_path)
+                if log is not None:
+                    log.collect()
+            else:
+                if log is not None:
+                    log.start(len(range(scene.frame_start,
+                        scene.frame_end + 1, scene.frame_step)))
+                with stage('bpy.ops.render.render'):
+                    bpy.ops.render.render(animation=True)
+
+            if log is not None:
+                log.finish()
         else:
             # Render still frame
-            scene.render.filepath = os.path.join(
+            filepath = os.path.join(
                 render_folder,
                 render_name + '.png')
-            bpy.ops.render.render(write_still=True)
+            scene.render.filepath = filepath
+            tile_list = rendering.worker_tiles()
+            if tile_list is not None:
+                # Render the tiles assigned to this worker process
+                rendering.render_tiles(scene, tiles, tile_list,
+                    os.path.splitext(filepath)[0] + '_tiles')
+                return
+
+            if cache:
+                render_cache = RenderCache(max_size=cache_size)
+                key = scene_fingerprint(scene)
+                if render_cache.get(key, filepath):
+                    print('Render cache:', render_cache.stats())
+                    return
+
+            if tiles is not None:
+                # Split the image into tiles rendered by worker processes
+                rendering.render_still_tiled(scene, filepath, tiles,
+                    workers, threads, key if cache else None)
+            else:
+                with stage('bpy.ops.render.render'):
+                    bpy.ops.render.render(write_still=True)
+
+            if cache:
+                render_cache.put(key, filepath)
+                print('Render cache:', render_cache.stats())
 
 
 def bmesh_to_object(bm, name='Object'):
-    mesh = bpy.data.meshes.new(name + 'Mesh')
-    bm.to_mesh(mesh)
+    mesh = new_mesh(name + 'Mesh')
+    with stage('bm.to_mesh'):
+        bm.to_mesh(mesh)
     bm.free()
 
     obj = bpy.data.objects.new(name, mesh)
     bpy.context.scene.collection.objects.link(obj)
 
     return obj
+
+
+def bmesh_to_arrays(bm):
+    # Vertex array, flat loop index array and face sizes of a bmesh
+    bm.verts.index_update()
+    verts = np.array([v.co[:] for v in bm.verts], dtype=np.float32)
+    faces = [[v.index for v in face.verts] for face in bm.faces]
+    loops = np.array([idx for face in faces for idx in face], dtype=np.int32)
+    face_sizes = np.array([len(face) for face in faces], dtype=np.int32)
+
+    return verts.reshape(-1, 3), loops, face_sizes
+
+
+def create_mesh(verts, faces, name='Mesh', face_sizes=None,
+                material_indices=None):
+    # Create a mesh in bulk from a (n, 3) vertex array and either a (m, k)
+    # face index array or a flat loop index array with one size per face
+    verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+    loops = np.asarray(faces, dtype=np.int32)
+    if face_sizes is None:
+        face_sizes = np.full(len(loops), loops.shape[1])
+    loops = loops.ravel()
+    face_sizes = np.asarray(face_sizes, dtype=np.int32)
+    loop_start = np.zeros(len(face_sizes), dtype=np.int32)
+    np.cumsum(face_sizes[:-1], out=loop_start[1:])
+
+    mesh = new_mesh(name)
+    mesh.vertices.add(len(verts))
+    mesh.vertices.foreach_set('co', verts.ravel())
+    mesh.loops.add(len(loops))
+    mesh.loops.foreach_set('vertex_index', loops)
+    mesh.polygons.add(len(face_sizes))
+    mesh.polygons.foreach_set('loop_start', loop_start)
+    # Since Blender 4.0 the loop totals are derived from the loop starts
+    if bpy.app.version < (4, 0, 0):
+        mesh.polygons.foreach_set('loop_total', face_sizes)
+    if material_indices is not None:
+        mesh.polygons.foreach_set('material_index',
+            np.asarray(material_indices, dtype=np.int32))
+    mesh.update(calc_edges=True)
+
+    return mesh
+
+
+def arrays_to_object(verts, faces, name='Object', face_sizes=None,
+                     material_indices=None):
+    mesh = create_mesh(verts, faces, name + 'Mesh', face_sizes,
+        material_indices)
+
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    return obj
+
+
+def weld_vertices(verts, faces, decimals=6):
+    # Merge vertices which are equal after rounding to the given decimals
+    # and remap the face indices to the merged vertices
+    verts = np.asarray(verts)
+    # Adding zero turns -0.0 into 0.0 so both end up in the same bucket
+    keys = np.round(verts, decimals) + 0.0
+    _, index, inverse = np.unique(
+        keys, axis=0, return_index=True, return_inverse=True)
+
+    return verts[index], inverse.reshape(-1)[faces]
+
+
+# Record the calls of all helpers when profiling is enabled
+profiling.instrument(globals(), __name__)
@@ -0,0 +1,96 @@
+import numpy as np
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+
+class FrameCache():
+    # Cache of per-frame arrays for deterministic frame-driven geometry.
+    # Recently used frames are kept in memory, all computed frames are
+    # stored in a memory-mapped file keyed by the generator parameters.
+    def __init__(self, name, params, shape, num_frames, dtype=np.float32,
+                 max_frames=64, folder='cache', version=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+
+        # Key the store by the parameters, the frame shape, the dtype and
+        # the version of the code which computes the frames
+        key = json.dumps(
+            [params, self.shape, num_frames, self.dtype.str, version],
+            sort_keys=True, default=str)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+        folder = os.path.join(os.getcwd(), folder)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, '{}-{}'.format(name, digest))
+
+        # Memory-mapped frame data and a mask of already computed frames
+        self.data = self._open_memmap(
+            path + '.npy', (num_frames,) + self.shape, self.dtype)
+        self.computed = self._open_memmap(
+            path + '-computed.npy', (num_frames,), np.bool_)
+
+
+    @staticmethod
+    def _open_memmap(path, shape, dtype):
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r+')
+            if array.shape == shape and array.dtype == dtype:
+                return array
+            del array
+
+        # Create the store under a temporary name and rename it, so that
+        # other processes which use the same store, like parallel render
+        # workers, never see a truncated or partially created file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        array = np.lib.format.open_memmap(tmp_path, mode='w+',
+            shape=shape, dtype=dtype)
+        array.flush()
+        del array
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r+')
+
+
+    def get(self, frame, compute):
+        # Return the array for the frame and call compute(frame) on a miss
+        if frame in self.frames:
+            self.frames.move_to_end(frame)
+            self.memory_hits += 1
+            return self.frames[frame]
+
+        if self.computed[frame]:
+            self.disk_hits += 1
+            values = np.array(self.data[frame])
+        else:
+            self.misses += 1
+            values = np.asarray(compute(frame), dtype=self.dtype)
+            values = values.reshape(self.shape)
+            # Mark the frame as computed only after its data is written
+            self.data[frame] = values
+            self.data.flush()
+            self.computed[frame] = True
+            self.computed.flush()
+
+        # Keep a bounded number of recently used frames in memory
+        self.frames[frame] = values
+        if len(self.frames) > self.max_frames:
+            self.frames.popitem(last=False)
+
+        return values
+
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / total if total else 0.0,
+            'computed_frames': int(self.computed.sum())
+        }
@@ -0,0 +1,88 @@
+import bpy
+
+
+class MaterialCache():
+    # Cache of materials by their node input values, where a material is
+    # shared by all inputs with the same names whose values differ by at
+    # most the tolerance from the values it was created with. The shared
+    # materials must not be changed by the callers.
+    def __init__(self, tolerance=1e-3):
+        self.tolerance = tolerance
+        self.materials = {}
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+
+    def key(self, inputs):
+        # Names and sizes of the inputs and their flat values, both sorted
+        # by the input name
+        names, values = [], []
+        for name, value in sorted(inputs.items()):
+            value = tuple(value) if hasattr(value, '__len__') else (value,)
+            names.append((name, len(value)))
+            values.extend(value)
+        return tuple(names), tuple(values)
+
+
+    def matches(self, a, b):
+        return all(abs(x - y) <= self.tolerance for x, y in zip(a, b))
+
+
+    def get(self, inputs):
+        # Existing material within the tolerance of the inputs or None
+        names, values = self.key(inputs)
+        # Drop the entries of materials which were removed in the meantime
+        entries = [entry for entry in self.materials.get(names, [])
+                   if is_valid(entry[1])]
+        self.materials[names] = entries
+        mat = next((entry_mat for entry_values, entry_mat in entries
+                    if self.matches(entry_values, values)), None)
+        if mat is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mat
+
+
+    def put(self, inputs, mat):
+        names, values = self.key(inputs)
+        self.materials.setdefault(names, []).append((values, mat))
+
+
+    def evict(self, remove=True):
+        # Remove the entries of materials which are not used anymore and
+        # the materials themselves in one batch
+        unused = []
+        for names, entries in self.materials.items():
+            kept = []
+            for values, mat in entries:
+                if not is_valid(mat):
+                    self.evictions += 1
+                elif mat.users == 0:
+                    self.evictions += 1
+                    unused.append(mat)
+                else:
+                    kept.append((values, mat))
+            self.materials[names] = kept
+        if remove and unused:
+            bpy.data.batch_remove(unused)
+        return len(unused)
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': sum(len(entries) for entries in self.materials.values())
+        }
+
+
+def is_valid(block):
+    # Whether the data-block was not removed
+    try:
+        block.name
+    except ReferenceError:
+        return False
+    return True
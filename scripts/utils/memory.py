@@ -0,0 +1,139 @@
+import bpy
+import contextlib
+import os
+
+# Data-block collections of bpy.data which are accounted and purged
+DATA_TYPES = ['objects', 'meshes', 'curves', 'metaballs', 'materials',
+    'textures', 'images', 'lights', 'cameras', 'node_groups', 'actions',
+    'worlds', 'collections', 'fonts']
+
+# Rough size of a data-block without its element data in bytes
+BLOCK_BYTES = 1024
+
+# With BLENDER_TRACK_LEAKS the data-blocks are counted after each scene
+# reset, which walks all data-blocks and is therefore off by default
+TRACK_LEAKS = 'BLENDER_TRACK_LEAKS' in os.environ
+
+
+def estimate_bytes(block):
+    # Estimated memory of the element data of a data-block in bytes
+    size = BLOCK_BYTES
+    if isinstance(block, bpy.types.Mesh):
+        size += 16*len(block.vertices) + 8*len(block.edges) + \
+            8*len(block.loops) + 12*len(block.polygons)
+        for attribute in getattr(block, 'attributes', []):
+            size += 4*len(attribute.data)
+    elif isinstance(block, bpy.types.Image):
+        if block.has_data:
+            width, height = block.size
+            size += width*height*block.channels*(4 if block.is_float else 1)
+    elif isinstance(block, bpy.types.Curve):
+        for spline in block.splines:
+            size += 48*(len(spline.points) + len(spline.bezier_points))
+    elif isinstance(block, bpy.types.MetaBall):
+        size += 64*len(block.elements)
+    elif isinstance(block, bpy.types.Action):
+        for fcurve in block.fcurves:
+            size += 40*len(fcurve.keyframe_points)
+    return size
+
+
+def datablock_stats(types=DATA_TYPES):
+    # Number of data-blocks, number of orphans without users and the
+    # estimated memory in bytes for each data-block type
+    stats = {}
+    for data_type in types:
+        blocks = getattr(bpy.data, data_type, None)
+        if blocks is None:
+            continue
+        stats[data_type] = {
+            'count': len(blocks),
+            'orphans': sum(1 for block in blocks
+                           if block.users == 0 and not block.use_fake_user),
+            'bytes': sum(estimate_bytes(block) for block in blocks)
+        }
+    return stats
+
+
+def print_stats(stats, before=None):
+    # Table of the data-block stats and the change since before
+    print('{:<14} {:>8} {:>8} {:>12} {:>10}'.format(
+        'type', 'count', 'orphans', 'bytes', 'change'))
+    for data_type, entry in stats.items():
+        change = ''
+        if before is not None and data_type in before:
+            change = '{:+d}'.format(
+                entry['count'] - before[data_type]['count'])
+        print('{:<14} {:>8} {:>8} {:>12} {:>10}'.format(
+            data_type, entry['count'], entry['orphans'], entry['bytes'],
+            change))
+
+
+@contextlib.contextmanager
+def memory_stage(name):
+    # Report the data-blocks before and after the stage
+    before = datablock_stats()
+    yield
+    after = datablock_stats()
+    print('Data-blocks after {}:'.format(name))
+    print_stats(after, before)
+
+
+def purge_orphans(types=DATA_TYPES, max_passes=8):
+    # Remove all data-blocks without users in bulk, which is repeated since
+    # removing a mesh can leave its materials without users. This also
+    # removes unused data-blocks of the session which were not created by
+    # the scripts, like worlds, images or node groups of an open file.
+    removed = {}
+    for _ in range(max_passes):
+        orphans = []
+        for data_type in types:
+            blocks = getattr(bpy.data, data_type, None)
+            if blocks is None:
+                continue
+            found = [block for block in blocks
+                     if block.users == 0 and not block.use_fake_user]
+            if found:
+                removed[data_type] = removed.get(data_type, 0) + len(found)
+                orphans.extend(found)
+        if not orphans:
+            break
+        bpy.data.batch_remove(orphans)
+    return removed
+
+
+class LeakDetector():
+    # Snapshots of the data-block counts after repeated runs, a type leaks
+    # if its count grows in each of the last runs
+    def __init__(self, min_runs=3):
+        self.min_runs = min_runs
+        self.snapshots = []
+
+
+    def snapshot(self, label=None):
+        self.snapshots.append((label, datablock_stats()))
+
+
+    def leaks(self):
+        if len(self.snapshots) < self.min_runs:
+            return {}
+        recent = [stats for _, stats in self.snapshots[-self.min_runs:]]
+        leaks = {}
+        for data_type in recent[-1]:
+            counts = [stats.get(data_type, {'count': 0})['count']
+                      for stats in recent]
+            if all(a < b for a, b in zip(counts, counts[1:])):
+                leaks[data_type] = counts
+        return leaks
+
+
+    def report(self):
+        leaks = self.leaks()
+        for data_type, counts in leaks.items():
+            print('Possible leak of {}: {} after the last {} runs'.format(
+                data_type, counts, len(counts)))
+        return leaks
+
+
+# Data-blocks which are left after each scene reset in this session
+leak_detector = LeakDetector()
@@ -0,0 +1,156 @@
+import bpy
+import contextlib
+import functools
+import atexit
+import json
+import time
+import os
+
+from .memory import datablock_stats
+
+# Stage profiling which is enabled by setting the environment variable
+# BLENDER_PROFILE to the path of the trace file (or 1 for profile.json).
+# The trace can be opened in chrome://tracing or https://ui.perfetto.dev.
+# When it is disabled, stage() returns a shared empty context manager and
+# profile() and instrument() return the functions unchanged.
+TRACE_PATH = os.environ.get('BLENDER_PROFILE')
+if TRACE_PATH == '1':
+    TRACE_PATH = 'profile.json'
+# With BLENDER_PROFILE_MEMORY each stage also records the change of the
+# data-block counts and their estimated memory, which is much slower
+PROFILE_MEMORY = 'BLENDER_PROFILE_MEMORY' in os.environ
+
+
+class Profiler():
+    # Nested stage timings recorded as Chrome trace events
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stack = []
+        self.summary = {}
+
+
+    def begin(self, name):
+        self.stack.append([name, time.perf_counter(), 0.0,
+            datablock_totals() if PROFILE_MEMORY else None])
+
+
+    def end(self):
+        name, start, children, datablocks = self.stack.pop()
+        duration = time.perf_counter() - start
+        if self.stack:
+            self.stack[-1][2] += duration
+        event = {
+            'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+            'ts': (start - self.origin)*1e6, 'dur': duration*1e6
+        }
+        if datablocks is not None:
+            # Change of the data-blocks and their memory in the stage
+            count, size = datablock_totals()
+            event['args'] = {'datablocks': count - datablocks[0],
+                             'bytes': size - datablocks[1]}
+        self.events.append(event)
+        # Number of calls, total time and time without nested stages
+        stats = self.summary.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += duration - children
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, f)
+
+
+    def print_summary(self):
+        print('{:<40} {:>8} {:>12} {:>12}'.format(
+            'stage', 'calls', 'total [s]', 'self [s]'))
+        for name, (calls, total, self_time) in sorted(
+                self.summary.items(), key=lambda item: -item[1][2]):
+            print('{:<40} {:>8} {:>12.4f} {:>12.4f}'.format(
+                name, calls, total, self_time))
+
+
+def datablock_totals():
+    # Total number of data-blocks and their estimated memory in bytes
+    stats = datablock_stats()
+    return (sum(entry['count'] for entry in stats.values()),
+            sum(entry['bytes'] for entry in stats.values()))
+
+
+profiler = Profiler() if TRACE_PATH is not None else None
+NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    # Context manager which records the time spent in the named stage
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
+
+
+def profile(func, name=None):
+    # Decorator which records each call of the function as a stage
+    if profiler is None:
+        return func
+    name = name or '{}.{}'.format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profiler.stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument(namespace, module_name):
+    # Wrap all public functions defined in the module namespace, which
+    # also profiles the calls between the functions of the module
+    if profiler is None:
+        return
+    for key, value in list(namespace.items()):
+        if callable(value) and not isinstance(value, type) and \
+                not key.startswith('_') and \
+                getattr(value, '__module__', None) == module_name:
+            namespace[key] = profile(value)
+
+
+def finish():
+    # Write the trace file and print the summary, workers of the parallel
+    # render write their own trace file
+    path = TRACE_PATH
+    worker = os.environ.get('BLENDER_RENDER_WORKER')
+    if worker is not None:
+        root, ext = os.path.splitext(path)
+        path = '{}-worker{}{}'.format(root, worker, ext)
+    profiler.write_trace(path)
+    profiler.print_summary()
+    print('Profile trace written to', os.path.abspath(path))
+
+
+if profiler is not None:
+    TRACE_PATH = os.path.abspath(TRACE_PATH)
+
+    # Record the depsgraph evaluation as a stage
+    @bpy.app.handlers.persistent
+    def depsgraph_update_pre(scene, *args):
+        if not profiler.stack or profiler.stack[-1][0] != 'depsgraph_update':
+            profiler.begin('depsgraph_update')
+
+    @bpy.app.handlers.persistent
+    def depsgraph_update_post(scene, *args):
+        if profiler.stack and profiler.stack[-1][0] == 'depsgraph_update':
+            profiler.end()
+
+    bpy.app.handlers.depsgraph_update_pre.append(depsgraph_update_pre)
+    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update_post)
+    atexit.register(finish)
@@ -0,0 +1,288 @@
+import bpy
+import numpy as np
+import hashlib
+import shutil
+import os
+
+from . import profiling
+
+# Properties which do not change the rendered pixels, or which differ
+# between sessions like the session id of a data-block
+IGNORED_PROPERTIES = {'rna_type', 'name', 'name_full', 'filepath', 'select',
+    'session_uid', 'users', 'use_fake_user', 'use_extra_user', 'tag',
+    'is_evaluated', 'original', 'is_runtime_data', 'preview', 'asset_data',
+    'library', 'library_weak_reference', 'override_library'}
+
+# Maximal depth of the nested structs which are hashed with their owner,
+# like the curves of a curve mapping of the color management settings
+MAX_DEPTH = 4
+
+# Object properties which change the rendered pixels, the transform, the
+# geometry and the materials of an object are hashed separately
+OBJECT_PROPERTIES = ['hide_render', 'visible_camera', 'visible_diffuse',
+    'visible_glossy', 'visible_transmission', 'visible_volume_scatter',
+    'visible_shadow', 'is_holdout', 'is_shadow_catcher', 'color',
+    'pass_index', 'instance_type', 'use_instance_vertices_rotation',
+    'use_instance_faces_scale', 'instance_faces_scale',
+    'show_instancer_for_render']
+
+# Node properties which only change the node editor, or which are hashed
+# separately like the input values and the links of the node tree
+NODE_PROPERTIES = IGNORED_PROPERTIES | {'location', 'width', 'height',
+    'dimensions', 'hide', 'show_options', 'show_preview', 'show_texture',
+    'use_custom_color', 'color', 'label', 'parent', 'inputs', 'outputs',
+    'internal_links'}
+
+# Attribute data types with the property and number of values per element
+ATTRIBUTE_TYPES = {
+    'FLOAT': ('value', 1, np.float32),
+    'INT': ('value', 1, np.int32),
+    'BOOLEAN': ('value', 1, np.bool_),
+    'FLOAT2': ('vector', 2, np.float32),
+    'FLOAT_VECTOR': ('vector', 3, np.float32),
+    'FLOAT_COLOR': ('color', 4, np.float32),
+    'BYTE_COLOR': ('color', 4, np.float32)
+}
+
+
+def hash_value(h, identifier, value):
+    if isinstance(value, set):
+        value = tuple(sorted(value))
+    elif hasattr(value, '__len__') and not isinstance(value, str):
+        value = tuple(value)
+    h.update(repr((identifier, value)).encode('utf-8'))
+
+
+def hash_properties(h, data, exclude=IGNORED_PROPERTIES, depth=0, seen=None):
+    # Hash all values of the data and of the structs nested in it, where
+    # data-blocks the data points to are only hashed by their name
+    if seen is None:
+        seen = set()
+    seen.add(data.as_pointer())
+    for prop in data.bl_rna.properties:
+        if prop.identifier in exclude:
+            continue
+        value = getattr(data, prop.identifier, None)
+        if prop.type == 'POINTER':
+            hash_pointer(h, prop.identifier, value, exclude, depth, seen)
+        elif prop.type == 'COLLECTION':
+            for i, item in enumerate(value if value is not None else []):
+                hash_pointer(h, (prop.identifier, i), item, exclude, depth,
+                             seen)
+        else:
+            hash_value(h, prop.identifier, value)
+
+
+def hash_pointer(h, identifier, value, exclude, depth, seen):
+    if value is None or isinstance(value, bpy.types.ID):
+        hash_value(h, identifier, getattr(value, 'name', None))
+    elif depth < MAX_DEPTH and value.as_pointer() not in seen:
+        hash_value(h, identifier, value.bl_rna.identifier)
+        hash_properties(h, value, exclude, depth + 1, seen)
+
+
+def hash_array(h, collection, prop, size, dtype):
+    values = np.empty(len(collection)*size, dtype=dtype)
+    collection.foreach_get(prop, values)
+    h.update(values.tobytes())
+
+
+def hash_mesh(h, mesh):
+    # Hash the geometry, the shading and all attributes of the mesh
+    hash_array(h, mesh.vertices, 'co', 3, np.float32)
+    hash_array(h, mesh.loops, 'vertex_index', 1, np.int32)
+    hash_array(h, mesh.polygons, 'loop_start', 1, np.int32)
+    hash_array(h, mesh.polygons, 'material_index', 1, np.int32)
+    hash_array(h, mesh.polygons, 'use_smooth', 1, np.bool_)
+    for attribute in getattr(mesh, 'attributes', []):
+        if attribute.data_type not in ATTRIBUTE_TYPES:
+            continue
+        prop, size, dtype = ATTRIBUTE_TYPES[attribute.data_type]
+        h.update(repr((attribute.name, attribute.domain)).encode('utf-8'))
+        hash_array(h, attribute.data, prop, size, dtype)
+
+
+def hash_node_tree(h, node_tree):
+    # Hash the nodes, their input values and the links of the node tree
+    if node_tree is None:
+        return
+    for node in sorted(node_tree.nodes, key=lambda node: node.name):
+        h.update(repr((node.name, node.bl_idname)).encode('utf-8'))
+        hash_properties(h, node, NODE_PROPERTIES)
+        for socket in node.inputs:
+            if hasattr(socket, 'default_value'):
+                value = socket.default_value
+                if hasattr(value, '__len__'):
+                    value = tuple(value)
+                h.update(repr((socket.identifier, value)).encode('utf-8'))
+        if getattr(node, 'image', None) is not None:
+            h.update(node.image.filepath.encode('utf-8'))
+        if getattr(node, 'node_tree', None) is not None:
+            hash_node_tree(h, node.node_tree)
+    for link in node_tree.links:
+        h.update(repr((
+            link.from_node.name, link.from_socket.identifier,
+            link.to_node.name, link.to_socket.identifier)).encode('utf-8'))
+
+
+def hash_material(h, material):
+    hash_properties(h, material)
+    if material.use_nodes:
+        hash_node_tree(h, material.node_tree)
+
+
+def scene_fingerprint(scene):
+    # Hash of the scene state which affects the rendered pixels of the
+    # current frame, which is the evaluated geometry with modifiers and
+    # animation, the materials, the lights, the camera and the settings
+    h = hashlib.sha1()
+    h.update(repr(scene.frame_current).encode('utf-8'))
+    hash_properties(h, scene.render)
+    hash_properties(h, scene.view_settings)
+    hash_properties(h, scene.display_settings)
+    for settings in ('cycles', 'eevee'):
+        if hasattr(scene, settings):
+            hash_properties(h, getattr(scene, settings))
+    if scene.camera is not None:
+        h.update(scene.camera.name.encode('utf-8'))
+    if scene.world is not None:
+        hash_properties(h, scene.world)
+        if scene.world.use_nodes:
+            hash_node_tree(h, scene.world.node_tree)
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    materials = {}
+    for obj in sorted(depsgraph.objects, key=lambda obj: obj.name):
+        if obj.hide_render:
+            continue
+        h.update(repr((obj.name, obj.type)).encode('utf-8'))
+        h.update(np.array(obj.matrix_world, dtype=np.float32).tobytes())
+        for name in OBJECT_PROPERTIES:
+            hash_value(h, name, getattr(obj, name, None))
+        for slot in obj.material_slots:
+            if slot.material is not None:
+                h.update(slot.material.name.encode('utf-8'))
+                materials[slot.material.name] = slot.material
+
+        if obj.type in ('MESH', 'CURVE', 'SURFACE', 'FONT', 'META'):
+            # Hash the evaluated geometry with all modifiers applied
+            mesh = obj.to_mesh()
+            if mesh is not None:
+                hash_mesh(h, mesh)
+            obj.to_mesh_clear()
+        elif obj.data is not None:
+            # Lights, cameras and other object data
+            hash_properties(h, obj.data)
+            if getattr(obj.data, 'use_nodes', False):
+                hash_node_tree(h, obj.data.node_tree)
+
+    for name in sorted(materials):
+        hash_material(h, materials[name])
+
+    return h.hexdigest()
+
+
+class RenderCache():
+    # Content-addressed store of rendered images in a local folder, where
+    # each image is keyed by the fingerprint of the scene it was rendered
+    # from. The least recently used images are evicted above max_size bytes.
+    def __init__(self, folder='cache/render', max_size=2**30):
+        self.folder = os.path.join(os.getcwd(), folder)
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.max_size = max_size
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+
+    def path(self, key, filepath):
+        return os.path.join(self.folder, key + os.path.splitext(filepath)[1])
+
+
+    def get(self, key, filepath):
+        # Copy the cached image to the filepath and return whether it exists
+        path = self.path(key, filepath)
+        if not os.path.exists(path):
+            self.misses += 1
+            return False
+        shutil.copyfile(path, filepath)
+        # Mark the image as recently used for the eviction
+        os.utime(path)
+        self.hits += 1
+        return True
+
+
+    def put(self, key, filepath, evict=True):
+        # Store the rendered image, the rename makes sure that an interrupted
+        # copy never leaves a broken image in the cache
+        if not os.path.exists(filepath):
+            return
+        path = self.path(key, filepath)
+        shutil.copyfile(filepath, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if evict:
+            self.evict()
+
+
+    def entries(self):
+        # Cached images with their last access time and size
+        entries = []
+        for filename in os.listdir(self.folder):
+            path = os.path.join(self.folder, filename)
+            if not filename.endswith('.tmp') and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+
+    def evict(self):
+        # Remove the least recently used images until the size limit is met
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= entry_size
+            self.evictions += 1
+
+
+    def restore_frames(self, scene):
+        # Copy the cached frames of the animation to their output paths and
+        # return the fingerprints of the frames which need to be rendered
+        frame_current = scene.frame_current
+        keys = {}
+        for frame in range(scene.frame_start, scene.frame_end + 1,
+                           scene.frame_step):
+            scene.frame_set(frame)
+            key = scene_fingerprint(scene)
+            path = scene.render.frame_path(frame=frame)
+            if not self.get(key, path):
+                keys[frame] = key
+                # Remove outdated frames so that they are rendered again
+                if os.path.exists(path):
+                    os.remove(path)
+        scene.frame_set(frame_current)
+        return keys
+
+
+    def store_frames(self, scene, keys):
+        for frame, key in keys.items():
+            self.put(key, scene.render.frame_path(frame=frame), evict=False)
+        self.evict()
+
+
+    def stats(self):
+        total = self.hits + self.misses
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum(entry[1] for entry in entries)
+        }
+
+
+# Only the fingerprint is profiled, the hash helpers are called too often
+scene_fingerprint = profiling.profile(scene_fingerprint)
@@ -0,0 +1,285 @@
+import bpy
+import numpy as np
+import subprocess
+import random
+import json
+import time
+import sys
+import os
+
+from . import profiling
+from .render_cache import scene_fingerprint
+
+# Environment variables which tell a Blender worker process what to render
+FRAMES_VARIABLE = 'BLENDER_RENDER_FRAMES'
+WORKER_VARIABLE = 'BLENDER_RENDER_WORKER'
+# Seed of the random generators, which the worker processes inherit so
+# that they build the same scene when they run the script again
+SEED_VARIABLE = 'BLENDER_RENDER_SEED'
+
+
+def seed_random():
+    # Seed the random generators of Numpy and random with the seed of the
+    # environment, or with a new seed which is stored in the environment
+    seed = os.environ.get(SEED_VARIABLE)
+    if seed is None:
+        seed = str(random.SystemRandom().randrange(2**32))
+        os.environ[SEED_VARIABLE] = seed
+    np.random.seed(int(seed))
+    random.seed(int(seed))
+
+
+def worker_frames():
+    # Frames assigned to this process if it is a render worker, else None
+    frames = os.environ.get(FRAMES_VARIABLE)
+    if frames is None:
+        return None
+    return [int(frame) for frame in frames.split(',') if frame]
+
+
+def worker_command(threads=None):
+    # Command line to run the current script again in a background
+    # Blender process, where the script path is made absolute
+    args = sys.argv[1:]
+    run_script = os.environ.get('BLENDER_RUN_SCRIPT')
+    for i, arg in enumerate(args[:-1]):
+        if arg in ('-P', '--python') and run_script is not None:
+            args[i + 1] = run_script
+    if '-b' not in args and '--background' not in args:
+        args = ['-b'] + args
+    return [bpy.app.binary_path, '-t', str(threads or 0)] + args
+
+
+def write_manifest(manifest_path, **entry):
+    # Append one JSON line, lines of different workers do not interleave
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def render_frames(scene, frames, manifest_path=None, worker=0):
+    # Render each frame as a single frame animation, which writes the same
+    # file as a full animation render, and skip frames which exist already.
+    # Each frame is rendered to a temporary name and renamed when it is
+    # complete, so an interrupted render never leaves a truncated frame.
+    settings = scene.render
+    frame_start, frame_end = scene.frame_start, scene.frame_end
+    filepath = settings.filepath
+    paths = {frame: settings.frame_path(frame=frame) for frame in frames}
+    directory, name = os.path.split(filepath)
+    settings.filepath = os.path.join(directory, '.tmp-' + name)
+    try:
+        for frame in frames:
+            path = paths[frame]
+            if os.path.exists(path):
+                continue
+
+            start = time.perf_counter()
+            scene.frame_start = scene.frame_end = frame
+            with profiling.stage('bpy.ops.render.render'):
+                bpy.ops.render.render(animation=True)
+            os.replace(settings.frame_path(frame=frame), path)
+            seconds = time.perf_counter() - start
+
+            if manifest_path is not None:
+                write_manifest(manifest_path, frame=frame, worker=worker,
+                    seconds=seconds, path=path)
+    finally:
+        settings.filepath = filepath
+        scene.frame_start, scene.frame_end = frame_start, frame_end
+
+
+def render_animation_parallel(scene, workers, threads=None, manifest_path=None):
+    # Split the missing frames of the animation across background Blender
+    # worker processes, which each run the current script again
+    frames = [frame for frame in range(
+                  scene.frame_start, scene.frame_end + 1, scene.frame_step)
+              if not os.path.exists(scene.render.frame_path(frame=frame))]
+    print('Rendering {} frames with {} workers, {} frames exist already'.format(
+        len(frames), workers,
+        len(range(scene.frame_start, scene.frame_end + 1, scene.frame_step))
+        - len(frames)))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # Interleave the frames, so that expensive parts of the animation
+    # are spread over all workers
+    start = time.perf_counter()
+    processes = []
+    for worker in range(workers):
+        frames_worker = frames[worker::workers]
+        if not frames_worker:
+            continue
+        env = dict(os.environ)
+        env[FRAMES_VARIABLE] = ','.join(str(frame) for frame in frames_worker)
+        env[WORKER_VARIABLE] = str(worker)
+        if manifest_path is not None:
+            env['BLENDER_RENDER_MANIFEST'] = manifest_path
+        processes.append((worker, subprocess.Popen(
+            worker_command(threads), env=env)))
+
+    # Fail if a worker failed or did not write all of its frames, the
+    # frames which exist are kept for the next run
+    failed = [worker for worker, process in processes if process.wait() != 0]
+    missing = [frame for frame in frames
+               if not os.path.exists(scene.render.frame_path(frame=frame))]
+    if failed or missing:
+        raise RuntimeError('Workers {} failed and frames {} are missing, run '
+                           'again to render the missing frames'
+                           .format(failed, missing))
+    print('Rendered {} frames in {:.1f} s'.format(
+        len(frames), time.perf_counter() - start))
+
+
+# Environment variable with the tiles of a still image a worker renders
+TILES_VARIABLE = 'BLENDER_RENDER_TILES'
+
+
+def tile_grid(tiles):
+    # Number of tiles in x and y from a single number or a pair
+    if isinstance(tiles, int):
+        return tiles, tiles
+    return tuple(tiles)
+
+
+def tile_regions(scene, tiles):
+    # Pixel region (x0, x1, y0, y1) of each tile with the origin at the
+    # bottom left as in the border of the render settings
+    tiles_x, tiles_y = tile_grid(tiles)
+    percentage = scene.render.resolution_percentage / 100
+    width = int(scene.render.resolution_x*percentage)
+    height = int(scene.render.resolution_y*percentage)
+    regions = {}
+    for i in range(tiles_x):
+        for j in range(tiles_y):
+            regions[i, j] = (
+                i*width // tiles_x, (i + 1)*width // tiles_x,
+                j*height // tiles_y, (j + 1)*height // tiles_y)
+    return regions, (width, height)
+
+
+def tile_path(tile_folder, tile):
+    return os.path.join(tile_folder, 'tile_{}_{}.png'.format(*tile))
+
+
+def worker_tiles():
+    # Tiles assigned to this process if it is a tile worker, else None
+    tiles = os.environ.get(TILES_VARIABLE)
+    if tiles is None:
+        return None
+    return [tuple(int(i) for i in tile.split(','))
+            for tile in tiles.split(';') if tile]
+
+
+def render_tiles(scene, tiles, tile_list, tile_folder):
+    # Render each tile as a cropped border render, tiles which exist
+    # already are skipped so that an interrupted render can be resumed
+    regions, (width, height) = tile_regions(scene, tiles)
+    settings = scene.render
+    use_border, use_crop = settings.use_border, settings.use_crop_to_border
+    filepath = settings.filepath
+    settings.use_border, settings.use_crop_to_border = True, True
+
+    for tile in tile_list:
+        path = tile_path(tile_folder, tile)
+        if os.path.exists(path):
+            continue
+        x0, x1, y0, y1 = regions[tile]
+        settings.border_min_x, settings.border_max_x = x0 / width, x1 / width
+        settings.border_min_y, settings.border_max_y = y0 / height, y1 / height
+        settings.filepath = path
+        with profiling.stage('bpy.ops.render.render'):
+            bpy.ops.render.render(write_still=True)
+
+    settings.use_border, settings.use_crop_to_border = use_border, use_crop
+    settings.filepath = filepath
+
+
+def stitch_tiles(scene, tiles, tile_folder, filepath):
+    # Combine the rendered tiles into one PNG image
+    regions, (width, height) = tile_regions(scene, tiles)
+    pixels = np.zeros((height, width, 4), dtype=np.float32)
+    for tile, (x0, x1, y0, y1) in regions.items():
+        image = bpy.data.images.load(tile_path(tile_folder, tile))
+        w, h = image.size
+        tile_pixels = np.empty(w*h*4, dtype=np.float32)
+        image.pixels.foreach_get(tile_pixels)
+        bpy.data.images.remove(image)
+        if (w, h) != (x1 - x0, y1 - y0):
+            raise ValueError('Tile {} has {}x{} pixels instead of {}x{}'
+                .format(tile, w, h, x1 - x0, y1 - y0))
+        pixels[y0:y1, x0:x1] = tile_pixels.reshape(h, w, 4)
+
+    image = bpy.data.images.new('Stitched', width, height, alpha=True)
+    image.pixels.foreach_set(pixels.ravel())
+    image.filepath_raw = filepath
+    image.file_format = 'PNG'
+    image.save()
+    bpy.data.images.remove(image)
+
+
+def reset_tiles(tile_folder, key):
+    # Remove the tiles of a different scene state than the given key
+    key_path = os.path.join(tile_folder, 'key.txt')
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            if f.read() == key:
+                return
+    for filename in os.listdir(tile_folder):
+        os.remove(os.path.join(tile_folder, filename))
+    with open(key_path, 'w') as f:
+        f.write(key)
+
+
+def render_still_tiled(scene, filepath, tiles, workers=1, threads=None,
+                       fingerprint=None):
+    # Render a still image in tiles split across background Blender
+    # worker processes and stitch them into the final image. The tiles
+    # of a different scene, render settings or tile grid are removed.
+    tile_folder = os.path.splitext(filepath)[0] + '_tiles'
+    if not os.path.exists(tile_folder):
+        os.mkdir(tile_folder)
+    if fingerprint is None:
+        fingerprint = scene_fingerprint(scene)
+    reset_tiles(tile_folder, '{}-{}x{}'.format(fingerprint, *tile_grid(tiles)))
+    regions, _ = tile_regions(scene, tiles)
+    tile_list = [tile for tile in sorted(regions)
+                 if not os.path.exists(tile_path(tile_folder, tile))]
+    print('Rendering {} of {} tiles with {} workers, {}={}'.format(
+        len(tile_list), len(regions), workers, SEED_VARIABLE,
+        os.environ.get(SEED_VARIABLE)))
+
+    start = time.perf_counter()
+    if workers > 1:
+        if threads is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+        processes = []
+        for worker in range(workers):
+            tiles_worker = tile_list[worker::workers]
+            if not tiles_worker:
+                continue
+            env = dict(os.environ)
+            env[TILES_VARIABLE] = ';'.join(
+                '{},{}'.format(*tile) for tile in tiles_worker)
+            env[WORKER_VARIABLE] = str(worker)
+            processes.append((worker, subprocess.Popen(
+                worker_command(threads), env=env)))
+        failed = [worker for worker, process in processes
+                  if process.wait() != 0]
+    else:
+        failed = []
+        render_tiles(scene, tiles, tile_list, tile_folder)
+
+    # Fail if a worker failed or did not write all of its tiles
+    missing = [tile for tile in tile_list
+               if not os.path.exists(tile_path(tile_folder, tile))]
+    if failed or missing:
+        raise RuntimeError('Workers {} failed and tiles {} are missing, run '
+                           'again to render the missing tiles'
+                           .format(failed, missing))
+
+    stitch_tiles(scene, tiles, tile_folder, filepath)
+    print('Rendered {} tiles in {:.1f} s'.format(
+        len(tile_list), time.perf_counter() - start))
+
+
+profiling.instrument(globals(), __name__)
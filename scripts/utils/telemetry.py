@@ -0,0 +1,232 @@
+import bpy
+import numpy as np
+import glob
+import json
+import csv
+import time
+import os
+
+# Columns of the per-frame telemetry log
+FIELDS = ['frame', 'handlers', 'evaluation', 'render', 'total',
+          'peak_memory_mb', 'file_size', 'outlier']
+
+
+def memory_mb(field='VmHWM'):
+    # Resident (VmRSS) or peak resident (VmHWM) memory of this process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    # Reset the peak resident memory of this process (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def worker_path(path, worker):
+    # Path of the log of a worker process of a parallel render
+    root, ext = os.path.splitext(path)
+    return '{}-worker{}{}'.format(root, worker, ext)
+
+
+def parse_row(row):
+    # Record of the frame from a row of a CSV log
+    record = {}
+    for field, value in row.items():
+        if value == '':
+            record[field] = None
+        elif field == 'frame' or field == 'file_size':
+            record[field] = int(value)
+        elif field == 'outlier':
+            record[field] = value == 'True'
+        else:
+            record[field] = float(value)
+    return record
+
+
+class RenderTelemetry():
+    # Per-frame timings of an animation render recorded by render handlers.
+    # The frame change handlers are bracketed by our own handlers, which
+    # separates the time of the frame change handlers of the scripts from
+    # the depsgraph and modifier evaluation of the frame.
+    def __init__(self, path, outlier_factor=3.0):
+        self.worker = os.environ.get('BLENDER_RENDER_WORKER')
+        if self.worker is not None:
+            path = worker_path(path, self.worker)
+        self.path = path
+        self.outlier_factor = outlier_factor
+        self.frames = []
+        self.current = {}
+        self.num_frames = None
+
+
+    def start(self, num_frames):
+        # Install the handlers and start a new log for num_frames frames
+        self.num_frames = num_frames
+        self.start_time = time.perf_counter()
+        handlers = bpy.app.handlers
+        handlers.frame_change_pre.insert(0, self.frame_change_start)
+        handlers.frame_change_pre.append(self.frame_change_end)
+        handlers.frame_change_post.append(self.frame_change_post)
+        handlers.render_pre.append(self.render_pre)
+        handlers.render_post.append(self.render_post)
+        handlers.render_write.append(self.render_write)
+        if self.path.endswith('.csv'):
+            with open(self.path, 'w') as f:
+                f.write(','.join(FIELDS) + '\n')
+        if self.worker is None:
+            # Remove the logs of the worker processes of an earlier render
+            for path in glob.glob(worker_path(self.path, '*')):
+                os.remove(path)
+
+
+    def stop(self):
+        handlers = bpy.app.handlers
+        for handler_list, handler in (
+                (handlers.frame_change_pre, self.frame_change_start),
+                (handlers.frame_change_pre, self.frame_change_end),
+                (handlers.frame_change_post, self.frame_change_post),
+                (handlers.render_pre, self.render_pre),
+                (handlers.render_post, self.render_post),
+                (handlers.render_write, self.render_write)):
+            if handler in handler_list:
+                handler_list.remove(handler)
+
+
+    def frame_change_start(self, scene, *args):
+        reset_peak_memory()
+        now = time.perf_counter()
+        self.current = {'start': now, 'handlers': 0.0, 'evaluation': 0.0}
+        self.time = now
+
+
+    def frame_change_end(self, scene, *args):
+        now = time.perf_counter()
+        self.current['handlers'] = now - self.time
+        self.time = now
+
+
+    def frame_change_post(self, scene, *args):
+        self.current['evaluation'] = time.perf_counter() - self.time
+
+
+    def render_pre(self, scene, *args):
+        if 'start' not in self.current:
+            self.frame_change_start(scene)
+        self.time = time.perf_counter()
+
+
+    def render_post(self, scene, *args):
+        self.current['render'] = time.perf_counter() - self.time
+
+
+    def render_write(self, scene, *args):
+        # The frame is written, so all timings of the frame are complete
+        frame = scene.frame_current
+        path = scene.render.frame_path(frame=frame)
+        record = {
+            'frame': frame,
+            'handlers': self.current.get('handlers', 0.0),
+            'evaluation': self.current.get('evaluation', 0.0),
+            'render': self.current.get('render', 0.0),
+            'total': time.perf_counter() - self.current['start'],
+            'peak_memory_mb': memory_mb('VmHWM'),
+            'file_size': os.path.getsize(path) if os.path.exists(path) else None
+        }
+        record['outlier'] = self.is_outlier(record['total'])
+        self.frames.append(record)
+        self.current = {}
+
+        self.write_rows([record])
+        self.report(record)
+
+
+    def write_rows(self, records):
+        if self.path.endswith('.csv'):
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(','.join('' if record[field] is None else
+                        str(record[field]) for field in FIELDS) + '\n')
+
+
+    def collect(self):
+        # Add the frames of the logs of the worker processes of a parallel
+        # render, so that the summary covers all frames
+        records = []
+        for path in sorted(glob.glob(worker_path(self.path, '*'))):
+            if path.endswith('.csv'):
+                with open(path) as f:
+                    for row in csv.DictReader(f):
+                        records.append(parse_row(row))
+            else:
+                with open(path) as f:
+                    records.extend(json.load(f)['frames'])
+        records.sort(key=lambda record: record['frame'])
+        self.frames.extend(records)
+        self.write_rows(records)
+
+
+    def is_outlier(self, seconds, totals=None):
+        # Robust outlier test with the median absolute deviation of the
+        # previous frames, which needs a few frames to be meaningful
+        if totals is None:
+            totals = [record['total'] for record in self.frames]
+        if len(totals) < 5:
+            return False
+        median = np.median(totals)
+        mad = 1.4826*np.median(np.abs(np.array(totals) - median))
+        return bool(seconds > median + self.outlier_factor*max(mad, 0.05*median))
+
+
+    def report(self, record):
+        # Print the frame time and the remaining time from recent frames
+        done = len(self.frames)
+        recent = [r['total'] for r in self.frames[-10:]]
+        remaining = max(self.num_frames - done, 0)*np.mean(recent)
+        print('Frame {} ({}/{}) {:.2f} s, handlers {:.2f} s, evaluation '
+              '{:.2f} s, render {:.2f} s, ETA {}{}'.format(
+              record['frame'], done, self.num_frames, record['total'],
+              record['handlers'], record['evaluation'], record['render'],
+              format_seconds(remaining),
+              ', OUTLIER' if record['outlier'] else ''))
+
+
+    def finish(self):
+        # Remove the handlers, write the log and print a summary, where
+        # outliers are determined with all frames of the render
+        if self.num_frames is None:
+            return
+        self.stop()
+        totals = [record['total'] for record in self.frames]
+        outliers = [record['frame'] for record in self.frames
+                    if self.is_outlier(record['total'], totals)]
+        summary = {
+            'frames': len(self.frames),
+            'seconds': time.perf_counter() - self.start_time,
+            'mean': float(np.mean(totals)) if totals else 0.0,
+            'median': float(np.median(totals)) if totals else 0.0,
+            'outliers': outliers
+        }
+        if not self.path.endswith('.csv'):
+            with open(self.path, 'w') as f:
+                json.dump({'summary': summary, 'frames': self.frames}, f,
+                    indent=2)
+        print('Rendered {frames} frames in {seconds:.1f} s, mean {mean:.2f} s, '
+              'median {median:.2f} s, outlier frames {outliers}'.format(
+              **summary))
+        print('Render telemetry written to', self.path)
@@ -0,0 +1,79 @@
+import numpy as np
+import scipy.spatial as spatial
+import itertools as it
+
+# Bounded Voronoi diagrams for the sphere (or disk in 2D) and box domains
+# centered at the origin. This module needs scipy and is therefore not
+# imported by utils itself.
+
+
+def flatten_regions(regions):
+    # Flat loop index array, size and first loop of each region or ridge
+    sizes = np.fromiter(map(len, regions), dtype=np.int64, count=len(regions))
+    loops = np.fromiter(it.chain.from_iterable(regions), dtype=np.int64,
+        count=sizes.sum())
+    return loops, sizes, np.cumsum(sizes) - sizes
+
+
+def sample_domain(n, dim=3, domain='sphere', r=1, rng=None):
+    # Uniformly distributed seed points inside the domain
+    rng = np.random.default_rng(rng)
+    if domain == 'sphere':
+        directions = rng.standard_normal((n, dim))
+        directions /= np.linalg.norm(directions, axis=1)[:, None]
+        return directions*r*rng.random((n, 1))**(1 / dim)
+    elif domain == 'box':
+        return r*(2*rng.random((n, dim)) - 1)
+    else:
+        raise ValueError('Unknown domain \'{}\''.format(domain))
+
+
+def mirror_points(points, domain='sphere', r=1, margin=None):
+    # Reflect the points within the margin of the boundary at the boundary.
+    # A mirrored point is never closer than its original to any location
+    # inside the domain, it only bounds the cells at the boundary. For the
+    # box this bounds the cells exactly by its faces, for the sphere each
+    # boundary cell is bounded by the tangent plane at its seed instead of
+    # the sphere, so the cells are a polyhedral approximation whose
+    # corners can reach outside of the sphere, the more the fewer points.
+    if margin is None:
+        margin = np.inf
+    if domain == 'sphere':
+        # Reflect at the tangent plane of the closest point on the sphere
+        norm = np.linalg.norm(points, axis=1)
+        near = (r - norm < margin) & (norm > 0)
+        mirrored = [points[near]*((2*r - norm[near]) / norm[near])[:, None]]
+    elif domain == 'box':
+        mirrored = []
+        for axis, side in it.product(range(points.shape[1]), (-r, r)):
+            near = np.abs(side - points[:, axis]) < margin
+            reflected = points[near].copy()
+            reflected[:, axis] = 2*side - reflected[:, axis]
+            mirrored.append(reflected)
+    else:
+        raise ValueError('Unknown domain \'{}\''.format(domain))
+
+    return np.concatenate(mirrored)
+
+
+def bounded_voronoi(points, domain='sphere', r=1, margin='auto'):
+    # Voronoi diagram where the cells of the given points are bounded by
+    # the domain, or by its tangent planes for the sphere, the mirrored
+    # points are appended after the given points
+    points = np.asarray(points, dtype=float)
+    n, dim = points.shape
+    if margin == 'auto':
+        # Mirror only points within a few mean seed distances of the
+        # boundary and fall back to mirror all points if that is not enough
+        margin = 4*2*r / n**(1 / dim)
+    vor = spatial.Voronoi(np.concatenate(
+        (points, mirror_points(points, domain, r, margin))))
+
+    loops, sizes, starts = flatten_regions(
+        [vor.regions[i] for i in vor.point_region[:n]])
+    unbounded = (sizes == 0) | \
+        (np.add.reduceat(np.append(loops == -1, False), starts) > 0)
+    if margin is not None and np.any(unbounded):
+        return bounded_voronoi(points, domain, r, None)
+
+    return vor
@@ -0,0 +1,181 @@
+import numpy as np
+import scipy.spatial as spatial
+import subprocess
+import tempfile
+import sys
+import os
+
+# Pure NumPy part of the Voronoi sphere, which does not import bpy. The
+# tiles of the tiled Voronoi sphere are computed by running this file in
+# plain Python worker processes with
+#
+#   python utils/voronoi_tiles.py <folder> <tiles> <r> <offset> <halo> <tile> ...
+#
+# where <folder> contains the seed points in points.npy and each tile is
+# written to tile_<tile>.npz. Forking Blender is unsafe since it runs many
+# threads, and spawned processes would run the Blender script again.
+# Run as a file, the module imports its neighbor voronoi.py directly,
+# since the utils package itself imports bpy.
+if __package__:
+    from .voronoi import flatten_regions
+else:
+    from voronoi import flatten_regions
+
+
+def voronoi_cells(vor, r=2, offset=0.02, cells=None):
+    # Faces of all closed Voronoi cells inside the radius r, where the
+    # vertices of each cell are moved by offset towards its center
+    loops, sizes, starts = flatten_regions(vor.ridge_vertices)
+    num_points, num_ridges = len(vor.points), len(sizes)
+
+    # Vertices outside of radius r reduced to a mask per ridge, ridges
+    # of unbounded cells are left out
+    outside = np.linalg.norm(vor.vertices, axis=1) > r
+    ridge_open = np.add.reduceat(loops == -1, starts) > 0
+    ridge_outside = np.add.reduceat(outside[loops], starts) > 0
+
+    # CSR-style adjacency from cells to the ridges between two cells
+    ridge_ids = np.tile(np.flatnonzero(~ridge_open), 2)
+    ridge_cells = np.concatenate((
+        vor.ridge_points[~ridge_open, 0], vor.ridge_points[~ridge_open, 1]))
+    order = np.argsort(ridge_cells, kind='stable')
+    ridge_ids, ridge_cells = ridge_ids[order], ridge_cells[order]
+    counts = np.bincount(ridge_cells, minlength=num_points)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+
+    # Skip all cells outside of radius r and cells with a single face
+    num_outside = np.add.reduceat(
+        np.append(ridge_outside[ridge_ids], False), indptr[:-1])
+    keep = (counts > 1) & (num_outside == 0)
+    if cells is not None:
+        keep &= cells
+    keep_faces = keep[ridge_cells]
+    face_ridges, face_cells = ridge_ids[keep_faces], ridge_cells[keep_faces]
+
+    # Gather the loops of the faces of all kept cells
+    face_sizes = sizes[face_ridges]
+    face_starts = np.cumsum(face_sizes) - face_sizes
+    faces = np.repeat(np.arange(len(face_ridges)), face_sizes)
+    positions = np.arange(len(faces)) - face_starts[faces]
+    face_loops = loops[starts[face_ridges][faces] + positions]
+
+    # Orient all faces away from the center of their cell
+    P = vor.vertices[face_loops]
+    next_loops = np.arange(len(faces)) + 1
+    next_loops[face_starts + face_sizes - 1] = face_starts
+    normals = np.add.reduceat(np.cross(P, P[next_loops]), face_starts)
+    centroids = np.add.reduceat(P, face_starts) / face_sizes[:, None]
+    centers = vor.points[face_cells]
+    flip = np.einsum('ij,ij->i', normals, centroids - centers) < 0
+    flip = np.repeat(flip, face_sizes)
+    order = np.where(flip,
+        face_starts[faces] + face_sizes[faces] - 1 - positions,
+        np.arange(len(faces)))
+    face_loops = face_loops[order]
+
+    # Create one offset vertex for each pair of cell and Voronoi vertex,
+    # the keys are int64 since the int32 ridge points overflow otherwise
+    keys = face_cells[faces].astype(np.int64)*len(vor.vertices) + face_loops
+    keys, face_loops = np.unique(keys, return_inverse=True)
+    vertex_cells, vertex_indices = np.divmod(keys, len(vor.vertices))
+    P = vor.vertices[vertex_indices]
+    v = vor.points[vertex_cells] - P
+    verts = P + offset*v / np.linalg.norm(v, axis=1)[:, None]
+
+    return verts, face_loops.reshape(-1), face_sizes, face_cells
+
+
+def tile_ids(points, tiles, r=2):
+    # Flat index of the tile of each point of the cube [-r, r]^3 split
+    # into tiles^3 tiles
+    size = 2*r / tiles
+    index = np.clip(np.floor((points + r) / size).astype(np.int64),
+                    0, tiles - 1)
+    return np.ravel_multi_index(index.T, (tiles,)*3)
+
+
+def voronoi_tile(points, ids, tile, tiles, r=2, offset=0.02, halo=0.5):
+    # Faces of the Voronoi cells owned by one tile, computed from the
+    # points of the tile and all other points within the halo distance.
+    # The halo is doubled until all cells of the tile are correct, which
+    # ends at the latest when the halo covers the whole cube.
+    size = 2*r / tiles
+    lower = -r + np.array(np.unravel_index(tile, (tiles,)*3))*size
+    upper = lower + size
+    own = np.flatnonzero(ids == tile)
+    while True:
+        # Points of the tile first, followed by the halo points
+        inside = np.all((lower - halo <= points) & (points <= upper + halo),
+                        axis=1)
+        inside[own] = False
+        tile_points = np.concatenate((points[own], points[inside]))
+        owned = np.arange(len(tile_points)) < len(own)
+
+        vor = spatial.Voronoi(tile_points)
+        verts, loops, face_sizes, face_cells = voronoi_cells(
+            vor, r, offset, owned)
+
+        # A Voronoi vertex of an owned cell is only guaranteed to be correct
+        # if its empty sphere lies within the known points or the domain
+        known_lower = np.where(lower - halo > -r, lower - halo, -np.inf)
+        known_upper = np.where(upper + halo < r, upper + halo, np.inf)
+        if np.all(np.isinf(known_lower)) and np.all(np.isinf(known_upper)):
+            break
+        ridge_loops, ridge_sizes, _ = flatten_regions(vor.ridge_vertices)
+        ridges = np.repeat(np.arange(len(ridge_sizes)), ridge_sizes)
+        ridge_points = vor.ridge_points[ridges]
+        valid = (ridge_loops != -1) & owned[ridge_points].any(axis=1)
+        P = vor.vertices[ridge_loops[valid]]
+        radius = np.linalg.norm(P - tile_points[ridge_points[valid, 0]], axis=1)
+        unsafe = np.any((P - radius[:, None] < known_lower) |
+                        (P + radius[:, None] > known_upper), axis=1)
+        if not np.isin(ridge_points[valid][unsafe], face_cells).any():
+            break
+        halo *= 2
+
+    # Cells as indices of the points instead of the points of the tile
+    return verts, loops, face_sizes, own[face_cells]
+
+
+def voronoi_tiles(points, tiles, r=2, offset=0.02, halo=0.5, workers=1):
+    # Compute the tiles one by one or split across worker processes and
+    # return them in the order of the tiles
+    num_tiles = tiles**3
+    if workers <= 1:
+        ids = tile_ids(points, tiles, r)
+        return [voronoi_tile(points, ids, tile, tiles, r, offset, halo)
+                for tile in range(num_tiles)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        np.save(os.path.join(folder, 'points.npy'), points)
+        processes = []
+        for worker in range(workers):
+            tiles_worker = range(num_tiles)[worker::workers]
+            if not tiles_worker:
+                continue
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), folder,
+                 str(int(tiles)), str(float(r)), str(float(offset)),
+                 str(float(halo))] +
+                [str(tile) for tile in tiles_worker]))
+        if any(process.wait() != 0 for process in processes):
+            raise RuntimeError('Voronoi tile workers failed')
+
+        results = []
+        for tile in range(num_tiles):
+            with np.load(os.path.join(folder, 'tile_{}.npz'.format(tile))) as f:
+                results.append((f['verts'], f['loops'], f['face_sizes'],
+                                f['cells']))
+        return results
+
+
+if __name__ == '__main__':
+    folder, tiles, r, offset, halo = sys.argv[1:6]
+    tiles, r, offset, halo = int(tiles), float(r), float(offset), float(halo)
+    points = np.load(os.path.join(folder, 'points.npy'), mmap_mode='r')
+    ids = tile_ids(points, tiles, r)
+    for tile in sys.argv[6:]:
+        verts, loops, face_sizes, cells = voronoi_tile(
+            points, ids, int(tile), tiles, r, offset, halo)
+        np.savez(os.path.join(folder, 'tile_{}.npz'.format(tile)),
+            verts=verts, loops=loops, face_sizes=face_sizes, cells=cells)
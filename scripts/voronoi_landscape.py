@@ -1,11 +1,9 @@
 import bpy
-import bmesh
 import numpy as np
 import scipy.spatial as spatial
-from random import random
-from mathutils import Vector, Matrix
 import colorsys
 import utils
+from utils.voronoi import flatten_regions, bounded_voronoi
 
 
 # Convert hsv values to gamma corrected rgb values
@@ -16,73 +14,100 @@ def convert_hsv(hsv):
     return color
 
 
-def voronoi_landscape(n=1000, w=10, h=5):
-    # Create voronoi structure
-    points = np.random.normal(size=(n, 2))/4
-    vor = spatial.Voronoi(points)
-    verts, regions = vor.vertices, vor.regions
-
-    # Filter unused voronoi regions
-    regions = [region for region in regions
-                if not -1 in region and len(region) > 0]
-    regions = [region for region in regions
-                if np.all([np.linalg.norm(verts[i]) < 1.2 for i in region])]
-
-    # Create faces from voronoi regions
-    bm = bmesh.new()
-    vDict, faces = {}, []
-    for region in regions:
-        for idx in region:
-            if not idx in vDict:
-                x, y, z = verts[idx, 0]*w, verts[idx, 1]*w, 0
-                vert = bm.verts.new((x, y, z))
-                vDict[idx] = vert
-
-        face = bm.faces.new(tuple(vDict[i] for i in region))
-        faces.append(face)
-
-    bmesh.ops.recalc_face_normals(bm, faces=faces)
-
-    # Extrude faces randomly
-    top_faces = []
-    for face in faces:
-        r = bmesh.ops.extrude_discrete_faces(bm, faces=[face])
-        f = r['faces'][0]
-        top_faces.append(f)
-        bmesh.ops.translate(bm, vec=Vector((0, 0, random()*h)), verts=f.verts)
-        center = f.calc_center_bounds()
-        bmesh.ops.scale(bm, vec=Vector((0.8, 0.8, 0.8)), verts=f.verts, space=Matrix.Translation(-center))
+@utils.profile
+def voronoi_landscape(n=1000, w=10, h=5, n_colors=20, bounded=False):
+    if bounded:
+        # Sample points only inside the disk of radius 1.2 and clip the
+        # voronoi regions at the disk, so that all regions are used
+        points = np.random.normal(size=(2*n, 2))/4
+        points = points[np.linalg.norm(points, axis=1) < 1.2][:n]
+        vor = bounded_voronoi(points, 'sphere', 1.2)
+        loops, sizes, starts = flatten_regions(
+            [vor.regions[i] for i in vor.point_region[:len(points)]])
+        valid = np.ones(len(sizes), dtype=bool)
+    else:
+        # Create voronoi structure
+        points = np.random.normal(size=(n, 2))/4
+        vor = spatial.Voronoi(points)
+        loops, sizes, starts = flatten_regions(vor.regions)
+
+        # Filter unused voronoi regions, which are either empty, open or
+        # have a vertex outside of the radius 1.2
+        outside = (loops == -1) | \
+            (np.linalg.norm(vor.vertices[loops], axis=1) >= 1.2)
+        nonempty = sizes > 0
+        valid = np.zeros(len(sizes), dtype=bool)
+        valid[nonempty] = np.add.reduceat(outside, starts[nonempty]) == 0
+    verts = vor.vertices
+
+    loops = loops[np.repeat(valid, sizes)]
+    sizes = sizes[valid]
+    starts = np.cumsum(sizes) - sizes
+    regions = np.repeat(np.arange(len(sizes)), sizes)
+    # Position of each loop inside its region
+    positions = np.arange(len(loops)) - starts[regions]
+
+    # Orient all regions counterclockwise, so that the faces point upwards
+    xy = verts[loops]*w
+    next_loops = np.arange(len(loops)) + 1
+    next_loops[starts + sizes - 1] = starts
+    area = np.add.reduceat(
+        xy[:, 0]*xy[next_loops, 1] - xy[next_loops, 0]*xy[:, 1], starts)
+    flip = np.repeat(area < 0, sizes)
+    order = np.where(flip, starts[regions] + sizes[regions] - 1 - positions,
+        np.arange(len(loops)))
+    loops, xy = loops[order], xy[order]
+
+    # Bottom vertices are shared between neighboring regions
+    base_indices, base_loops = np.unique(loops, return_inverse=True)
+    base_loops = base_loops.reshape(-1)
+    base_verts = np.zeros((len(base_indices), 3))
+    base_verts[:, :2] = verts[base_indices]*w
+
+    # Extrude regions randomly and scale the top faces by 0.8 around
+    # the center of their bounds
+    heights = np.random.random(len(sizes))*h
+    center = 0.5*(np.minimum.reduceat(xy, starts) +
+                  np.maximum.reduceat(xy, starts))
+    top_verts = np.empty((len(loops), 3))
+    top_verts[:, :2] = center[regions] + 0.8*(xy - center[regions])
+    top_verts[:, 2] = heights[regions]
+    top_loops = len(base_verts) + np.arange(len(loops))
+
+    # Side walls connect each edge of the bottom with the top of a region
+    wall_faces = np.stack((
+        base_loops, base_loops[next_loops],
+        top_loops[next_loops], top_loops), axis=-1)
+
+    # Assign material index to each bar, the top face and its side walls
+    material_indices = np.random.randint(n_colors, size=len(sizes))
+
+    # Create the mesh from the top faces followed by the side walls
+    me = utils.create_mesh(
+        np.concatenate((base_verts, top_verts)),
+        np.concatenate((top_loops, wall_faces.ravel())),
+        "VornoiMesh",
+        np.concatenate((sizes, np.full(len(loops), 4))),
+        np.concatenate((material_indices, material_indices[regions])))
+    obj = bpy.data.objects.new("Voronoi", me)
+    bpy.context.scene.collection.objects.link(obj)
 
     # Create list of random colors based on a range for each channel
     #color_range = [[0.7, 0.9], [0.7, 0.8], [0.8, 0.9]] # Pink
     color_range = [[0.5, 0.7], [0.7, 0.8], [0.8, 0.9]] # Blue
     #color_range = [[0.05, 0.15], [0.7, 0.8], [0.8, 0.9]] # Yellow
-    n_colors = 20
     colors = np.random.random((n_colors, 3))
     for i, r in zip(range(n_colors), color_range):
         print(r)
         colors[:, i] = (r[1] - r[0])*colors[:, i] + r[0]
 
-    # Assign material index to each bar
-    for face in top_faces:
-        idx = np.random.randint(len(colors))
-        face.material_index = idx
-        for edge in face.edges:
-            for f in edge.link_faces:
-                f.material_index = idx
-
-    # Create obj and mesh from bmesh object
-    me = bpy.data.meshes.new("VornoiMesh")
-    bm.to_mesh(me)
-    bm.free()
-    obj = bpy.data.objects.new("Voronoi", me)
-    bpy.context.scene.collection.objects.link(obj)
-
     # Create and assign materials to object
     for color in colors:
         mat = utils.create_material(convert_hsv(color))
         obj.data.materials.append(mat)
 
+    return obj
+
 
 if __name__ == '__main__':
     print(__file__)
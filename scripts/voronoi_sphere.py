@@ -1,61 +1,64 @@
 import bpy
-import bmesh
 import numpy as np
 import scipy.spatial as spatial
-from mathutils import Vector, Matrix
+import os
 import utils
-
-
-def VoronoiSphere(bm, points, r=2, offset=0.02, num_materials=1):
-    # Calculate 3D Voronoi diagram
-    vor = spatial.Voronoi(points)
-
-    faces_dict = {}
-    for (idx_p0, idx_p1), ridge_vertices in zip(vor.ridge_points, vor.ridge_vertices):
-        if -1 in ridge_vertices: continue
-        if idx_p0 not in faces_dict:
-            faces_dict[idx_p0] = []
-        if idx_p1 not in faces_dict:
-            faces_dict[idx_p1] = []
-
-        faces_dict[idx_p0].append(ridge_vertices)
-        faces_dict[idx_p1].append(ridge_vertices)
-
-    for idx_point in faces_dict:
-        region = faces_dict[idx_point]
-        center = Vector(vor.points[idx_point])
-        if len(region) <= 1: continue
-
-        # Skip all Voronoi regions outside of radius r
-        skip = False
-        for faces in region:
-            for idx in faces:
-                p = vor.vertices[idx]
-                if np.linalg.norm(p) > r:
-                    skip = True
-                    break
-
-        if not skip:
-            vertsDict = {}
-            material_index = np.random.randint(num_materials)
-
-            for faces in region:
-                verts = []
-                for idx in faces:
-                    p = Vector(vor.vertices[idx])
-                    if idx not in vertsDict:
-                        v = center - p
-                        v.normalize()
-                        vert = bm.verts.new(p + offset*v)
-                        verts.append(vert)
-                        vertsDict[idx] = vert
-                    else:
-                        verts.append(vertsDict[idx])
-
-                face = bm.faces.new(verts)
-                face.material_index = material_index
-
-    bmesh.ops.recalc_face_normals(bm, faces=bm.faces)
+from utils.voronoi import bounded_voronoi, sample_domain
+from utils.voronoi_tiles import voronoi_cells, voronoi_tiles
+
+
+# The cells are only profiled here, since voronoi_tiles does not import
+# the utils package
+voronoi_cells = utils.profile(voronoi_cells)
+
+
+@utils.profile
+def VoronoiSphere(points, r=2, offset=0.02, num_materials=1, bounded=False):
+    if bounded:
+        # Calculate 3D Voronoi diagram with all cells bounded by tangent
+        # planes of the sphere of radius r, so that no cell needs to be
+        # skipped, the cells are not clipped at the sphere itself
+        vor = bounded_voronoi(points, 'sphere', r)
+        cells = np.arange(len(vor.points)) < len(points)
+        verts, loops, face_sizes, face_cells = voronoi_cells(
+            vor, np.inf, offset, cells)
+    else:
+        # Calculate 3D Voronoi diagram
+        vor = spatial.Voronoi(points)
+        verts, loops, face_sizes, face_cells = voronoi_cells(vor, r, offset)
+
+    # Random material index for each cell
+    material_indices = np.random.randint(num_materials, size=len(points))
+
+    return verts, loops, face_sizes, material_indices[face_cells]
+
+
+@utils.profile
+def TiledVoronoiSphere(n=2000, r=2, tiles=2, workers=None, seed=0,
+                       offset=0.02, halo=None, num_materials=1):
+    # Compute the Voronoi sphere of n seed points in tiles^3 independent
+    # tiles in worker processes and merge the results in the order of the
+    # tiles. All points are sampled at once and split by tile, so the
+    # result neither depends on the number of tiles nor of workers.
+    rng = np.random.default_rng(seed)
+    points = (rng.random((n, 3)) - 0.5)*2*r
+    material_indices = rng.integers(num_materials, size=n)
+    if halo is None:
+        halo = 3*2*r / np.cbrt(n)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    results = voronoi_tiles(points, tiles, r, offset, halo,
+                            min(workers, tiles**3))
+
+    # Merge the tiles by offsetting the vertex indices of each tile
+    num_verts = np.cumsum([0] + [len(result[0]) for result in results])
+    verts = np.concatenate([result[0] for result in results])
+    loops = np.concatenate([result[1] + offset_verts
+        for result, offset_verts in zip(results, num_verts)])
+    face_sizes = np.concatenate([result[2] for result in results])
+    face_cells = np.concatenate([result[3] for result in results])
+
+    return verts, loops, face_sizes, material_indices[face_cells]
 
 
 if __name__ == '__main__':
@@ -77,12 +80,25 @@ if __name__ == '__main__':
     bpy.context.scene.world.use_nodes = False
     bpy.context.scene.world.color = palette[0]
 
-    # Create Voronoi Sphere
-    n, r = 2000, 2
-    points = (np.random.random((n, 3)) - 0.5)*2*r
-    bm = bmesh.new()
-    VoronoiSphere(bm, points, r, num_materials=len(palette)-1)
-    obj = utils.bmesh_to_object(bm)
+    # Create Voronoi Sphere, with more than one tile the Voronoi diagram
+    # is computed in parallel tiles, which is needed for millions of cells.
+    # A bounded Voronoi Sphere samples the seeds only inside the sphere
+    # and bounds the cells by tangent planes of the sphere, so that all
+    # cells are used.
+    n, r, tiles, bounded = 2000, 2, 1, False
+    if tiles > 1:
+        verts, loops, face_sizes, material_indices = TiledVoronoiSphere(
+            n, r, tiles, num_materials=len(palette)-1)
+    elif bounded:
+        points = sample_domain(n, 3, 'sphere', r)
+        verts, loops, face_sizes, material_indices = VoronoiSphere(
+            points, r, num_materials=len(palette)-1, bounded=True)
+    else:
+        points = (np.random.random((n, 3)) - 0.5)*2*r
+        verts, loops, face_sizes, material_indices = VoronoiSphere(
+            points, r, num_materials=len(palette)-1)
+    obj = utils.arrays_to_object(verts, loops,
+        face_sizes=face_sizes, material_indices=material_indices)
 
     # Apply materials to object
     for color in palette[1:]: